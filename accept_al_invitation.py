@@ -1,5 +1,6 @@
 import asyncio
 from synapse_client import SynapseClient
+from user_registry import iter_users
 import config
 
 
@@ -8,7 +9,7 @@ async def main():
     synapse = SynapseClient(config.BASE_URL)
 
     # Register users from CSV and store user IDs and access tokens
-    await synapse.accept_all_invitation(config.REGISTERED_USERS_CSV, config.ROOMS_JSON)
+    await synapse.accept_all_invitation(iter_users(config.REGISTERED_USERS_CSV), config.ROOMS_JSON)
 
     # Close the async client
     await synapse.close()
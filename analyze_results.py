@@ -0,0 +1,227 @@
+#!/bin/env python3
+
+import argparse
+import csv
+import glob
+import json
+import math
+import numpy as np
+from results_writer import open_results, iter_results
+
+
+# Latencies are binned on a log scale with 1% wide bins between 1us and ~3h,
+# so percentiles are exact to within 1% while every chunk is a single bincount.
+BIN_GROWTH = 1.01
+MIN_LATENCY = 1e-6
+NUM_BINS = int(math.ceil(math.log(1e4 / MIN_LATENCY) / math.log(BIN_GROWTH))) + 1
+BIN_EDGES = MIN_LATENCY * BIN_GROWTH ** np.arange(1, NUM_BINS + 1)
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Breakdowns reported by the analyzer: name -> columns forming the group key
+BREAKDOWNS = {
+    "total": (),
+    "operation": ("operation",),
+    "status": ("status",),
+    "is_whatsapp": ("is_whatsapp",),
+    "operation/is_whatsapp": ("operation", "is_whatsapp"),
+}
+
+
+def latency_bins(latency):
+    """Vectorized log-scale bin index of every latency (in seconds)."""
+    latency = np.maximum(latency.astype(np.float64), MIN_LATENCY)
+    bins = np.floor(np.log(latency / MIN_LATENCY) / math.log(BIN_GROWTH)).astype(np.int64)
+    return np.clip(bins, 0, NUM_BINS - 1)
+
+
+def _csv_chunk(rows, legacy):
+    """Convert a list of CSV rows into the analyzer's chunk arrays."""
+    if legacy:
+        # Timestamp,Time,Agent,Username,Target,Return Code,Msg Size,Execution Time (s),isWhatsApp[,RW,...]
+        timestamp = np.array([row[1] for row in rows], dtype=np.float64)
+        status = np.array([row[5] for row in rows], dtype=np.int16)
+        latency = np.array([row[7] for row in rows], dtype=np.float64)
+        is_whatsapp = np.array([row[8].strip() == "True" for row in rows])
+        operation = np.array([row[9].strip(" '") if len(row) > 9 else "unknown" for row in rows])
+    else:
+        # results_writer.RESULT_COLUMNS
+        timestamp = np.array([row[0] for row in rows], dtype=np.float64)
+        status = np.array([row[4] for row in rows], dtype=np.int16)
+        latency = np.array([row[6] for row in rows], dtype=np.float64)
+        is_whatsapp = np.array([row[7] == "True" for row in rows])
+        operation = np.array([row[8] for row in rows])
+    return {"timestamp": timestamp, "status": status, "latency": latency,
+            "is_whatsapp": is_whatsapp, "operation": operation}
+
+
+def iter_chunks(path, chunk_rows=1000000):
+    """Yield arrays of at most `chunk_rows` results from a CSV, npz directory or parquet file.
+
+    Understands both the current results_writer CSV and the legacy
+    agentN_<timestamp>.csv logs (asctime prefix, padded and quoted fields).
+    """
+    if not (path.endswith(".csv") or path.endswith(".csv.gz")):
+        for part in iter_results(path, batch_rows=chunk_rows):
+            yield {"timestamp": part["timestamp"] / 1e9,
+                   "status": part["status"],
+                   "latency": part["latency"],
+                   "is_whatsapp": part["is_whatsapp"],
+                   "operation": part["operation.dictionary"][part["operation"]]}
+        return
+    with open_results(path, "r") as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if not header:
+            return
+        legacy = header[0] == "Timestamp"
+        rows = []
+        for row in reader:
+            if len(row) < 9:
+                continue
+            rows.append(row)
+            if len(rows) >= chunk_rows:
+                yield _csv_chunk(rows, legacy)
+                rows = []
+        if rows:
+            yield _csv_chunk(rows, legacy)
+
+
+def _group_key(group, columns):
+    """Printable key of one breakdown group, e.g. "Write/True"."""
+    if not columns:
+        return "all"
+    values = group.tolist() if hasattr(group, "tolist") else group
+    if not isinstance(values, tuple):
+        values = (values,)
+    return "/".join(str(value) for value in values)
+
+
+class ResultsAnalyzer:
+    """Streaming aggregation of results chunks.
+
+    Keeps one latency bin-count vector per breakdown group plus per-interval
+    request and error counts, so memory depends on the number of groups and
+    the run length, not on the number of rows.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.counts = {name: {} for name in BREAKDOWNS}
+        self.errors = {name: {} for name in BREAKDOWNS}
+        self.timeline = {}  # interval index -> [requests, errors]
+
+    def add(self, chunk):
+        if not len(chunk["latency"]):
+            return
+        bins = latency_bins(chunk["latency"])
+        failed = chunk["status"] >= 400
+        for name, columns in BREAKDOWNS.items():
+            if columns:
+                keys = np.rec.fromarrays([chunk[column] for column in columns]) \
+                    if len(columns) > 1 else chunk[columns[0]]
+                groups, inverse = np.unique(keys, return_inverse=True)
+                inverse = inverse.ravel()
+            else:
+                groups, inverse = [()], np.zeros(len(bins), dtype=np.int64)
+            counts = np.bincount(inverse * NUM_BINS + bins, minlength=len(groups) * NUM_BINS)
+            group_errors = np.bincount(inverse, weights=failed, minlength=len(groups))
+            for idx, group in enumerate(groups):
+                key = _group_key(group, columns)
+                if key in self.counts[name]:
+                    self.counts[name][key] += counts[idx * NUM_BINS:(idx + 1) * NUM_BINS]
+                    self.errors[name][key] += int(group_errors[idx])
+                else:
+                    self.counts[name][key] = counts[idx * NUM_BINS:(idx + 1) * NUM_BINS].copy()
+                    self.errors[name][key] = int(group_errors[idx])
+
+        slots = np.floor(chunk["timestamp"] / self.interval).astype(np.int64)
+        slots, inverse = np.unique(slots, return_inverse=True)
+        requests = np.bincount(inverse.ravel(), minlength=len(slots))
+        slot_errors = np.bincount(inverse.ravel(), weights=failed, minlength=len(slots))
+        for slot, count, error_count in zip(slots.tolist(), requests.tolist(), slot_errors.tolist()):
+            entry = self.timeline.setdefault(slot, [0, 0])
+            entry[0] += count
+            entry[1] += int(error_count)
+
+    @staticmethod
+    def percentiles(counts):
+        cumulative = np.cumsum(counts)
+        total = cumulative[-1]
+        result = {}
+        for percentile in PERCENTILES:
+            index = int(np.searchsorted(cumulative, math.ceil(percentile / 100.0 * total)))
+            result[f"p{percentile:g}"] = round(float(BIN_EDGES[min(index, NUM_BINS - 1)]) * 1000, 3)
+        return result
+
+    def report(self):
+        """Latency percentiles (ms), counts and error rates per breakdown, plus throughput."""
+        report = {}
+        for name, groups in self.counts.items():
+            report[name] = {}
+            for key, counts in sorted(groups.items()):
+                total = int(counts.sum())
+                entry = {"count": total, "error_rate": round(self.errors[name][key] / total, 6)}
+                entry.update(self.percentiles(counts))
+                report[name][key] = entry
+        if self.timeline:
+            slots = np.array(sorted(self.timeline))
+            requests = np.array([self.timeline[slot][0] for slot in slots.tolist()])
+            duration = (slots[-1] - slots[0] + 1) * self.interval
+            report["throughput"] = {"duration_s": float(duration),
+                                    "mean_rps": round(float(requests.sum() / duration), 3),
+                                    "peak_rps": round(float(requests.max() / self.interval), 3)}
+        return report
+
+    def write_timeline(self, filename):
+        """Write requests/s and errors/s per interval as CSV."""
+        with open(filename, mode="w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["time", "requests_per_s", "errors_per_s"])
+            for slot in sorted(self.timeline):
+                requests, errors = self.timeline[slot]
+                writer.writerow([slot * self.interval, requests / self.interval, errors / self.interval])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Computes latency percentiles, error rates and throughput from run logs")
+    parser.add_argument("paths", nargs="+",
+                        help="Run logs (CSV, .csv.gz, .results directories, .parquet); globs allowed")
+    parser.add_argument("-i", "--interval", type=float, default=1.0,
+                        help="Throughput time series resolution (s)")
+    parser.add_argument("--chunk-rows", type=int, default=1000000,
+                        help="Rows processed per chunk")
+    parser.add_argument("-j", "--json", type=str, default=None,
+                        help="Write the report as JSON to this file")
+    parser.add_argument("-t", "--timeline", type=str, default=None,
+                        help="Write the throughput time series as CSV to this file")
+    args = parser.parse_args()
+
+    paths = sorted({path for pattern in args.paths for path in glob.glob(pattern)})
+    analyzer = ResultsAnalyzer(interval=args.interval)
+    rows = 0
+    for path in paths:
+        for chunk in iter_chunks(path, args.chunk_rows):
+            analyzer.add(chunk)
+            rows += len(chunk["latency"])
+        print(f"Loaded {path} ({rows} rows so far)")
+
+    report = analyzer.report()
+    for name in BREAKDOWNS:
+        print(f"\n== by {name}")
+        for key, entry in report[name].items():
+            print(f"{key:>24}: n={entry['count']} errors={entry['error_rate']:.2%} "
+                  + " ".join(f"{p}={entry[p]}ms" for p in entry if p.startswith("p")))
+    if "throughput" in report:
+        print(f"\nthroughput: {report['throughput']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    if args.timeline:
+        analyzer.write_timeline(args.timeline)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 BASE_URL = "https://connect.mudita.com"
 ADMIN_USERNAME = "admin_user"
 ADMIN_PASSWORD = "admin_password"
+ADMIN_ACCESS_TOKEN = None  # Admin token for admin APIs; None logs in as ADMIN_USERNAME
+# registration_shared_secret from homeserver.yaml, for register_user.py --backend admin
+REGISTRATION_SHARED_SECRET = None
 
 
 # Input and Output CSV files
@@ -10,5 +13,49 @@ OUTPUT_CSV = "registered_users.csv"
 REGISTERED_USERS_CSV = "registered_users.csv"
 
 ROOMS_JSON = "rooms.json"
+CREATE_ROOM_INVITE_CHUNK = 100  # Members invited by createRoom itself; the rest via /invite, this many at a time
+SYNC_TOKENS_JSON = "sync_tokens.json"  # Per-user since-tokens for warm /sync runs
+ROOM_INDEX_JSON = "room_index.json"  # Room classification index kept between runs
+CREATED_ROOMS_JSONL = "created_rooms.jsonl"  # provision.py checkpoint: one line per created room
+SYNC_TIMELINE_LIMIT = 10  # Timeline events per room in the load /sync filter
+SYNC_LAZY_LOAD_MEMBERS = False  # Lazy-load members in the load /sync filter
+HISTORY_PAGE_SIZE = 100  # Events per /messages page in the history workload
 
 DOMAIN = "connect.mudita.com"
+DEVICE_ID_PREFIX = "LOADTEST_"  # Test users always log in as device DEVICE_ID_PREFIX + username
+
+# Load generation
+CONCURRENCY = 50  # Max number of virtual users running at the same time
+MAX_CONNECTIONS = 100  # Size of the shared HTTP connection pool
+
+# End-to-end delivery measurement (send_message.py --delivery-listeners)
+DELIVERY_SYNC_TIMEOUT = 30000  # Long-poll /sync timeout of listeners (ms)
+DELIVERY_TIMELINE_LIMIT = 50  # Timeline events per room in a listener /sync; misses past it count as "gapped"
+DELIVERY_TIMEOUT = 60.0  # Seconds after which an unseen message counts as undelivered
+DELIVERY_GRACE = 10.0  # Seconds to wait for outstanding deliveries after the load ends
+DELIVERY_ROOM_SIZES = (2, 10, 50, 200, 1000)  # Upper bounds of the room size buckets
+
+# Retry policies for throttled (429) responses, per endpoint family
+# (send, createRoom, invite, join, sync, messages, login, register).
+# Families without an entry use "default". See matrix_api.RetryPolicy.
+RETRY_POLICIES = {
+    "default": {"retries": 5, "base_delay": 1.0, "max_delay": 30.0, "max_total": 60.0, "jitter": 0.5},
+    "send": {"retries": 5, "base_delay": 0.5, "max_delay": 10.0, "max_total": 30.0, "jitter": 0.5},
+}
+
+# Client-side token-bucket rate limits, see rate_limiter.RateLimiter.
+# Each limit is {"rate": requests_per_second, "burst": max_burst} or None.
+# "endpoint" limits are shared by all users, "user_endpoint" limits apply
+# to each user separately (Synapse's rc_message, rc_joins, ... are per user).
+RATE_LIMITS = {
+    "global": None,
+    "user": None,
+    "endpoint": {},
+    "user_endpoint": {
+        # "send": {"rate": 0.2, "burst": 10},
+        # "createRoom": {"rate": 0.2, "burst": 10},
+        # "invite": {"rate": 0.3, "burst": 10},
+        # "join": {"rate": 0.1, "burst": 10},
+        # "sync": {"rate": 1, "burst": 5},
+    },
+}
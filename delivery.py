@@ -0,0 +1,113 @@
+import asyncio
+import time
+import config
+
+
+# Content key carrying the transaction id of a tracked message
+MARKER = "org.matrix_client.txn_id"
+
+
+def room_size_bucket(members, bounds=config.DELIVERY_ROOM_SIZES):
+    """Label of the room size bucket a member count falls into, e.g. "members<=10"."""
+    if not members:
+        return "members:unknown"
+    for upper in bounds:
+        if members <= upper:
+            return f"members<={upper}"
+    return f"members>{bounds[-1]}"
+
+
+class DeliveryTracker:
+    """Matches messages seen by listener /sync loops to the sends that produced them.
+
+    Sends to rooms with at least one listener other than the sender (a
+    listener skips its own events) are registered with their send time and
+    carry their transaction id in the content (`MARKER`); the event_id is
+    added once the send returns. A listener that receives the
+    event looks it up by either and gets the send time back, so every
+    listening room member yields one send-to-delivery latency (a listener
+    seeing the same event again is not counted twice). Entries are dropped
+    after `timeout` seconds; those never delivered are counted as "gapped"
+    if a listener got a `limited` timeline for the room after the send (the
+    event may have been left out of its /sync), else as "undelivered".
+    """
+
+    def __init__(self, timeout=config.DELIVERY_TIMEOUT):
+        self.timeout = timeout
+        self.pending = {}  # txn_id -> [send_time, room_id, listeners that received it]
+        self.event_ids = {}  # event_id -> txn_id
+        self.rooms = {}  # room_id -> listeners that joined it
+        self.gaps = {}  # room_id -> time of the last limited listener timeline
+        self.delivered = 0
+        self.undelivered = 0
+        self.gapped = 0
+
+    def listen(self, listener, room_ids):
+        """Record the rooms a listener has joined."""
+        for room_id in room_ids:
+            self.rooms.setdefault(room_id, set()).add(listener)
+
+    def expect(self, txn_id, room_id, send_time, sender):
+        """Register a send; returns False (nothing to track) if no other listener is in the room."""
+        if not self.rooms.get(room_id, set()) - {sender}:
+            return False
+        self.pending[txn_id] = [send_time, room_id, set()]
+        return True
+
+    def sent(self, txn_id, event_id):
+        """Record the event_id of a send, or forget the send if it failed (event_id None)."""
+        if event_id is None:
+            self.pending.pop(txn_id, None)
+        elif txn_id in self.pending:
+            self.event_ids[event_id] = txn_id
+
+    def match(self, event, listener):
+        """Return the send time of a timeline event received by `listener`.
+
+        None if the event is not tracked or this listener already received it.
+        """
+        txn_id = event.get("content", {}).get(MARKER)
+        if txn_id is None:
+            txn_id = self.event_ids.get(event.get("event_id"))
+        entry = self.pending.get(txn_id)
+        if entry is None or listener in entry[2]:
+            return None
+        entry[2].add(listener)
+        self.delivered += 1
+        return entry[0]
+
+    def gap(self, room_id, received):
+        """Record that a listener's timeline of a room was `limited` at time `received`."""
+        self.gaps[room_id] = received
+
+    def expire(self, now=None):
+        """Drop sends older than the timeout, counting those nobody received."""
+        deadline = (now if now is not None else time.time()) - self.timeout
+        expired = [txn_id for txn_id, entry in self.pending.items() if entry[0] < deadline]
+        for txn_id in expired:
+            send_time, room_id, listeners = self.pending.pop(txn_id)
+            if listeners:
+                continue
+            if self.gaps.get(room_id, 0) > send_time:
+                self.gapped += 1
+            else:
+                self.undelivered += 1
+        if expired:
+            expired = set(expired)
+            self.event_ids = {event_id: txn_id for event_id, txn_id in self.event_ids.items()
+                              if txn_id not in expired}
+
+    def outstanding(self):
+        """Number of tracked sends no listener has received yet."""
+        return sum(1 for entry in self.pending.values() if not entry[2])
+
+    async def wait(self, timeout):
+        """Wait until every tracked send was received at least once, or `timeout` seconds."""
+        deadline = time.time() + timeout
+        while self.outstanding() and time.time() < deadline:
+            await asyncio.sleep(0.1)
+
+    def summary(self):
+        self.expire(now=float("inf"))
+        return {"deliveries": self.delivered, "undelivered": self.undelivered,
+                "gapped": self.gapped}
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import math
+import time
+from array import array
+
+
+class HdrHistogram:
+    """High dynamic range histogram of integer values (HdrHistogram layout).
+
+    Values between `lowest` and `highest` are kept with `significant_figures`
+    decimal digits of precision in a fixed array of counters, so recording is
+    O(1) and memory does not grow with the number of samples. Values above
+    `highest` are recorded as `highest`.
+    """
+
+    def __init__(self, lowest=1, highest=3_600_000_000, significant_figures=3):
+        self.lowest = lowest
+        self.highest = highest
+        self.significant_figures = significant_figures
+        self.unit_magnitude = int(math.floor(math.log2(lowest)))
+        sub_bucket_count_magnitude = int(math.ceil(math.log2(2 * 10 ** significant_figures)))
+        self.sub_bucket_half_count_magnitude = sub_bucket_count_magnitude - 1
+        self.sub_bucket_count = 1 << sub_bucket_count_magnitude
+        self.sub_bucket_half_count = self.sub_bucket_count // 2
+        self.sub_bucket_mask = (self.sub_bucket_count - 1) << self.unit_magnitude
+        smallest_untrackable = self.sub_bucket_count << self.unit_magnitude
+        bucket_count = 1
+        while smallest_untrackable <= highest:
+            smallest_untrackable <<= 1
+            bucket_count += 1
+        self.counts = array("q", [0]) * ((bucket_count + 1) * self.sub_bucket_half_count)
+        self.total_count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        bucket_index = ((value | self.sub_bucket_mask).bit_length()
+                        - self.unit_magnitude - self.sub_bucket_half_count_magnitude - 1)
+        sub_bucket_index = value >> (bucket_index + self.unit_magnitude)
+        return ((bucket_index + 1) << self.sub_bucket_half_count_magnitude) \
+            + sub_bucket_index - self.sub_bucket_half_count
+
+    def _value(self, index):
+        """Highest value that is recorded into counter `index`."""
+        bucket_index = (index >> self.sub_bucket_half_count_magnitude) - 1
+        sub_bucket_index = (index & (self.sub_bucket_half_count - 1)) + self.sub_bucket_half_count
+        if bucket_index < 0:
+            sub_bucket_index -= self.sub_bucket_half_count
+            bucket_index = 0
+        shift = bucket_index + self.unit_magnitude
+        return (sub_bucket_index << shift) + (1 << shift) - 1
+
+    def record(self, value, count=1):
+        """Record `value` (an integer >= 0) `count` times."""
+        value = min(max(int(value), 0), self.highest)
+        self.counts[self._index(value)] += count
+        self.total_count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percentile):
+        """Return the value at `percentile` (0-100), or 0 for an empty histogram."""
+        if not self.total_count:
+            return 0
+        target = max(1, int(math.ceil(percentile / 100.0 * self.total_count)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count:
+                seen += count
+                if seen >= target:
+                    return min(self._value(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.total_count if self.total_count else 0
+
+    def merge(self, other):
+        """Add all values recorded in `other` (same configuration) to this histogram."""
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total_count += other.total_count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def reset(self):
+        self.counts = array("q", [0]) * len(self.counts)
+        self.total_count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def summarize(histogram, scale=1000.0):
+    """Count, mean, percentiles and max of a microsecond histogram, in milliseconds."""
+    summary = {"count": histogram.total_count,
+               "mean": round(histogram.mean() / scale, 3)}
+    for percentile in PERCENTILES:
+        summary[f"p{percentile:g}"] = round(histogram.percentile(percentile) / scale, 3)
+    summary["max"] = round((histogram.max or 0) / scale, 3)
+    return summary
+
+
+class LatencyRecorder:
+    """In-memory latency histograms per operation, outcome and room type.
+
+    Latencies are recorded in microseconds into both a cumulative histogram
+    and an interval histogram that is reset on every snapshot.
+    """
+
+    def __init__(self, significant_figures=3):
+        self.significant_figures = significant_figures
+        self.histograms = {}
+        self.interval_histograms = {}
+        self.interval_start = time.time()
+
+    def _histogram(self, histograms, key):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = HdrHistogram(
+                significant_figures=self.significant_figures)
+        return histogram
+
+    def record(self, operation, outcome, room_type, seconds):
+        """Record one request of `operation` ("Read", "Write", ...) that took `seconds`."""
+        key = (operation, str(outcome), str(room_type))
+        value = int(seconds * 1_000_000)
+        self._histogram(self.histograms, key).record(value)
+        self._histogram(self.interval_histograms, key).record(value)
+
+    def merge(self, other):
+        """Add the cumulative histograms of another recorder (e.g. from a worker process)."""
+        for key, histogram in other.histograms.items():
+            self._histogram(self.histograms, key).merge(histogram)
+
+    def snapshot(self, interval=False):
+        """Summaries keyed by "operation/outcome/room_type".
+
+        With `interval=True` the summaries cover the time since the previous
+        interval snapshot and the interval histograms are reset.
+        """
+        histograms = self.interval_histograms if interval else self.histograms
+        snapshot = {"/".join(key): summarize(histogram)
+                    for key, histogram in sorted(histograms.items())}
+        if interval:
+            self.interval_histograms = {}
+            self.interval_start = time.time()
+        return snapshot
+
+    async def run_snapshots(self, interval, filename=None):
+        """Every `interval` seconds write an interval snapshot as one JSON line and print it."""
+        while True:
+            await asyncio.sleep(interval)
+            self.write_snapshot(filename, interval=True)
+
+    def write_snapshot(self, filename=None, interval=False):
+        """Append a snapshot to `filename` (JSON lines) and print a short summary."""
+        start = self.interval_start
+        snapshot = self.snapshot(interval=interval)
+        if filename:
+            with open(filename, mode="a", encoding="utf-8") as file:
+                file.write(json.dumps({"time": time.time(), "interval_start": start if interval else None,
+                                       "interval": interval, "latency_ms": snapshot}) + "\n")
+        for key, summary in snapshot.items():
+            print(f"{key}: n={summary['count']} p50={summary['p50']}ms "
+                  f"p99={summary['p99']}ms p99.9={summary['p99.9']}ms max={summary['max']}ms")
+        return snapshot
@@ -1,13 +1,28 @@
+import argparse
 import asyncio
 from synapse_client import SynapseClient
 import config
 
 
 async def main():
+    parser = argparse.ArgumentParser(
+        description="Gets access tokens for the users from config.INPUT_CSV")
+    parser.add_argument("-c", "--concurrency", type=int, default=config.CONCURRENCY,
+                        help="Max number of users handled at the same time")
+    parser.add_argument("-m", "--mode", choices=["password", "admin"], default="password",
+                        help="password: log every user in; admin: mint tokens with the admin "
+                             "\"login as user\" API (config.ADMIN_ACCESS_TOKEN or admin login)")
+    parser.add_argument("--relogin", action="store_true",
+                        help="Get new tokens for every user instead of keeping the valid ones "
+                             "in config.OUTPUT_CSV")
+    args = parser.parse_args()
+
     synapse = SynapseClient(config.BASE_URL)
 
-    # Register users from CSV and store user IDs and access tokens
-    await synapse.login_users_from_csv(config.INPUT_CSV, config.OUTPUT_CSV)
+    # Log users in and store user IDs and access tokens
+    await synapse.login_users_from_csv(config.INPUT_CSV, config.OUTPUT_CSV,
+                                       concurrency=args.concurrency, mode=args.mode,
+                                       reuse=not args.relogin)
 
     # Close the async client
     await synapse.close()
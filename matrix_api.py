@@ -1,34 +1,186 @@
+import asyncio
+import copy
+import random
+import re
+import time
+from email.utils import parsedate_to_datetime
 import httpx
 import requests
+import config
+from rate_limiter import RateLimiter
+
+
+# (pattern, family) pairs used to group endpoints for per-endpoint settings.
+ENDPOINT_FAMILIES = [
+    (re.compile(r"/rooms/[^/]+/send/"), "send"),
+    (re.compile(r"/createRoom$"), "createRoom"),
+    (re.compile(r"/rooms/[^/]+/invite$"), "invite"),
+    (re.compile(r"/rooms/[^/]+/join$|/join/"), "join"),
+    (re.compile(r"/sync$"), "sync"),
+    (re.compile(r"/rooms/[^/]+/messages$"), "messages"),
+    (re.compile(r"/_synapse/admin/v1/users/[^/]+/login$"), "admin_login"),
+    (re.compile(r"/login$"), "login"),
+    (re.compile(r"/_synapse/admin/v1/register$"), "admin_register"),
+    (re.compile(r"/register$"), "register"),
+]
+
+
+def endpoint_family(endpoint):
+    """Return the family name ("send", "sync", ...) of an endpoint path, or "default"."""
+    path = endpoint.split("?", 1)[0]
+    for pattern, family in ENDPOINT_FAMILIES:
+        if pattern.search(path):
+            return family
+    return "default"
+
+
+def retry_after(response):
+    """Return the server's requested wait in seconds, or None if it gave no hint.
+
+    Synapse sends `retry_after_ms` in the M_LIMIT_EXCEEDED body; proxies and
+    newer servers may send a standard `Retry-After` header instead.
+    """
+    headers = getattr(response, "headers", None) or {}
+    header = headers.get("Retry-After")
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    try:
+        retry_after_ms = response.json().get("retry_after_ms")
+    except Exception:
+        return None
+    if isinstance(retry_after_ms, (int, float)):
+        return retry_after_ms / 1000.0
+    return None
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter that honors server rate-limit hints."""
+
+    def __init__(self, retries=5, base_delay=1.0, max_delay=30.0, max_total=60.0,
+                 jitter=0.5, statuses=(429,)):
+        self.retries = retries  # Number of retries after the first attempt
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_total = max_total  # Cap on the total time spent sleeping
+        self.jitter = jitter  # Up to this fraction of the backoff delay is added at random
+        self.statuses = statuses
+
+    def delay(self, attempt, response):
+        """Seconds to wait before retry number `attempt` (0-based).
+
+        A server hint is waited out as given plus at most `jitter *
+        base_delay`, so retries neither come back early nor over-wait long
+        hints. Without a hint the backoff doubles up to `max_delay`, with up
+        to `jitter` of it added at random.
+        """
+        hint = retry_after(response)
+        if hint is not None:
+            return hint + random.uniform(0, self.jitter * self.base_delay)
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay * (1 + random.uniform(0, self.jitter))
 
 
 class MatrixAPI:
-    def __init__(self, base_url, access_token=None):
-        """Initialize with the base URL and optional access token."""
+    def __init__(self, base_url, access_token=None, client=None, rate_limiter=None):
+        """Initialize with the base URL, optional access token, shared HTTP client and rate limiter."""
         self.base_url = base_url.rstrip("/")
         self.access_token = access_token
-        self.client = httpx.AsyncClient(verify=False)
+        self.username = None
+        self.user_id = None
+        self._owns_client = client is None
+        if client is None:
+            limits = httpx.Limits(max_connections=config.MAX_CONNECTIONS,
+                                  max_keepalive_connections=config.MAX_CONNECTIONS)
+            client = httpx.AsyncClient(verify=False, limits=limits)
+        self.client = client
+        self.rate_limiter = rate_limiter or RateLimiter.from_config(config.RATE_LIMITS)
+        self.retry_policies = {family: RetryPolicy(**kwargs)
+                               for family, kwargs in config.RETRY_POLICIES.items()}
+
+    def as_user(self, access_token, username=None, user_id=None):
+        """Return a session bound to one user's credentials.
+
+        The session is a shallow copy of this client: it shares the HTTP
+        connection pool (and everything else) but carries its own access
+        token, so sessions for many users can be used concurrently without
+        ever mutating shared state.
+        """
+        session = copy.copy(self)
+        session.access_token = access_token
+        session.username = username
+        session.user_id = user_id
+        session._owns_client = False
+        return session
 
-    def set_access_token(self, token):
-        """Set or update the access token."""
-        self.access_token = token
+    def retry_policy(self, endpoint):
+        """Return the retry policy configured for the endpoint's family."""
+        return self.retry_policies.get(endpoint_family(endpoint),
+                                       self.retry_policies["default"])
 
-    async def _request(self, method, endpoint, data=None, params=None):
-        """Generic method for making async HTTP requests."""
+    async def _request(self, method, endpoint, data=None, params=None, retry=None, parser=None,
+                       timeout=None):
+        """Make a request through the rate limiter, retrying throttled responses
+        according to the retry policy.
+
+        `retry` overrides the endpoint's policy; pass `RetryPolicy(retries=0)`
+        for a single attempt. With a `parser` (an object with reset/feed/close)
+        a successful body is streamed into it instead of being read into memory.
+        `timeout` (seconds) overrides the client's HTTP timeout, e.g. for long polls.
+        """
+        family = endpoint_family(endpoint)
+        policy = retry or self.retry_policy(endpoint)
+        user = self.user_id or self.username or self.access_token
+        slept = 0.0
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire(family, user)
+            response = await self._send(method, endpoint, data, params, parser, timeout)
+            if response.status_code not in policy.statuses or attempt >= policy.retries:
+                return response
+            delay = policy.delay(attempt, response)
+            if slept + delay > policy.max_total:
+                return response
+            print(f"Rate limited on {family}, retrying in {delay:0.2f} seconds...")
+            await asyncio.sleep(delay)
+            slept += delay
+            attempt += 1
+
+    async def _send(self, method, endpoint, data=None, params=None, parser=None, timeout=None):
+        """Make a single async HTTP request."""
         url = f"{self.base_url}{endpoint}"
+        if timeout is None:
+            timeout = httpx.USE_CLIENT_DEFAULT
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.access_token}"} if self.access_token else {}
 
         try:
-            response = await self.client.request(method, url, json=data, params=params, headers=headers)
+            if parser is None:
+                response = await self.client.request(method, url, json=data, params=params,
+                                                     headers=headers, timeout=timeout)
+            else:
+                async with self.client.stream(method, url, json=data, params=params,
+                                              headers=headers, timeout=timeout) as response:
+                    if response.is_success:
+                        parser.reset()
+                        async for chunk in response.aiter_bytes():
+                            parser.feed(chunk)
+                        parser.close()
+                    else:
+                        await response.aread()
             response.raise_for_status()  # Raise an error for HTTP 4xx/5xx responses
             # return response.json()
             return response
 
         except httpx.RequestError as e:
             print(f"Request Error: {e}")
-            if hasattr(e.response, "status_code"):
+            if hasattr(getattr(e, "response", None), "status_code"):
             # return e.response.status_code
                 return e.response
             else:
@@ -44,6 +196,8 @@ class MatrixAPI:
                 fake_response = requests.Response()
                 fake_response.status_code = 500
                 return fake_response
+
     async def close(self):
-        """Close the HTTP client."""
-        await self.client.aclose()
+        """Close the HTTP client if this instance created it."""
+        if self._owns_client:
+            await self.client.aclose()
@@ -0,0 +1,194 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+from synapse_client import SynapseClient
+from user_registry import UserRecord, UserRegistry, iter_users, normalize_user_id
+import config
+import helper
+
+
+def room_key(room_users):
+    """Owner and sorted members of a room; a room is created again only if these change."""
+    owner, *members = [normalize_user_id(user_id) for user_id in room_users]
+    return owner, tuple(sorted(set(members) - {owner}))
+
+
+def load_created_rooms(filename):
+    """room_key -> checkpoint entry of the rooms in a created rooms checkpoint (JSON lines)."""
+    created = {}
+    if os.path.exists(filename):
+        with open(filename, mode="r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    room = json.loads(line)
+                    created[(room["owner"], tuple(room["members"]))] = room
+    return created
+
+
+class ProvisioningPipeline:
+    """Register users, create their rooms with invites and join, as one pipeline.
+
+    Every stage is a pool of workers connected to the next stage by a bounded
+    asyncio.Queue. A room is created (inviting its members, see
+    SynapseClient.create_room_with_members) as soon as its owner and all of
+    its members are registered, and each invite is accepted as soon as it
+    is sent, so the whole setup takes
+    about as long as the slowest stage instead of the sum of all of them.
+    Users that already have a token in the registered users CSV are not
+    registered again, and rooms already in the created rooms checkpoint
+    (same owner and members) are not created again; their invited members
+    are joined again instead, in case an earlier run stopped before the
+    joins (joining a room twice is harmless).
+    """
+
+    def __init__(self, synapse, rooms, registered_csv, concurrency=config.CONCURRENCY,
+                 queue_size=1000, backend="client", created_rooms=config.CREATED_ROOMS_JSONL):
+        self.synapse = synapse
+        self.rooms = rooms  # room name -> [owner, member, ...]
+        self.registered_csv = registered_csv
+        self.created_rooms = created_rooms
+        self.concurrency = concurrency
+        self.backend = backend
+        self.registry = UserRegistry(registered_csv)
+        self.created = load_created_rooms(created_rooms)  # room_key -> checkpoint entry
+        self.waiting = {}  # user_id -> names of the rooms waiting for that user
+        self.missing = {}  # room name -> number of its users not registered yet
+        self.counts = {"users": 0, "reused_users": 0, "rooms": 0, "reused_rooms": 0,
+                       "failed_rooms": 0, "invites": 0, "failed_invites": 0,
+                       "joins": 0, "failed_joins": 0}
+        for room_name, room_users in rooms.items():
+            user_ids = {normalize_user_id(user_id) for user_id in room_users}
+            self.missing[room_name] = len(user_ids)
+            for user_id in user_ids:
+                self.waiting.setdefault(user_id, []).append(room_name)
+        self.room_queue = asyncio.Queue(queue_size)
+        self.join_queue = asyncio.Queue(queue_size)
+        self.users_file = None
+        self.writer = None
+        self.rooms_file = None
+
+    async def register(self, user):
+        """Stage 1: make sure the user exists and has a token, then release its rooms."""
+        record = self.registry.get_by_username(user.username)
+        if record is not None and record.access_token:
+            self.counts["reused_users"] += 1
+        else:
+            row = await self.synapse.register_and_login(user.username, user.password, self.backend)
+            self.writer.writerow(row)
+            self.users_file.flush()  # The row is the checkpoint of this user
+            record = UserRecord(*row)
+            self.registry.add(record)
+            self.counts["users"] += 1
+        for room_name in self.waiting.pop(record.user_id, ()):
+            self.missing[room_name] -= 1
+            if not self.missing[room_name]:
+                await self.room_queue.put(room_name)
+
+    async def create_room(self, room_name):
+        """Stage 2: create a room as its owner, inviting its members, and queue their joins."""
+        key = room_key(self.rooms[room_name])
+        created = self.created.get(key)
+        if created is not None:
+            self.counts["reused_rooms"] += 1
+            for user_id in created.get("invited", created["members"]):
+                await self.join_queue.put((created["room_id"], self.registry.get(user_id)))
+            return
+        owner = self.registry.get(self.rooms[room_name][0])
+        members = {self.registry.get(user_id) for user_id in self.rooms[room_name][1:]}
+        members.discard(owner)
+        response, invited, failed = await self.synapse.user_session(owner).create_room_with_members(
+            room_name, [member.user_id for member in members])
+        if response.status_code != 200:
+            self.counts["failed_rooms"] += 1
+            print(f"Failed to create room {room_name}. Response: {response.status_code}")
+            return
+        self.counts["rooms"] += 1
+        self.counts["invites"] += len(invited)
+        self.counts["failed_invites"] += failed
+        room_id = response.json()["room_id"]
+        created = {"room_name": room_name, "room_id": room_id, "owner": key[0],
+                   "members": list(key[1]), "invited": sorted(invited)}
+        self.created[key] = created
+        self.rooms_file.write(json.dumps(created) + "\n")
+        self.rooms_file.flush()
+        for user_id in invited:
+            await self.join_queue.put((room_id, self.registry.get(user_id)))
+
+    async def join(self, item):
+        """Stage 3: accept the invite as the member."""
+        room_id, member = item
+        response = await self.synapse.user_session(member).accept_invitation(room_id)
+        self.counts["joins" if response.status_code == 200 else "failed_joins"] += 1
+
+    async def _consume(self, queue, worker):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            try:
+                await worker(item)
+            except Exception as e:
+                print(f"Worker error: {e}")
+
+    async def _drain(self, queue, workers):
+        """Tell a stage that no more work is coming and wait for it to finish."""
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    async def run(self, users):
+        """Provision an iterable of UserRecords (with passwords); returns the counts."""
+        start_time = time.time()
+        stages = [(queue, [asyncio.create_task(self._consume(queue, worker))
+                           for _ in range(self.concurrency)])
+                  for queue, worker in ((self.room_queue, self.create_room),
+                                        (self.join_queue, self.join))]
+        with open(self.registered_csv, mode="a", encoding="utf-8", newline="") as users_file, \
+                open(self.created_rooms, mode="a", encoding="utf-8") as rooms_file:
+            self.users_file, self.rooms_file = users_file, rooms_file
+            self.writer = csv.writer(users_file)
+            if users_file.tell() == 0:
+                self.writer.writerow(["username", "user_id", "access_token"])  # Headers
+            _, failed = await helper.run_concurrently(users, self.register, self.concurrency,
+                                                      desc="provisioning", collect=False)
+            for queue, workers in stages:
+                await self._drain(queue, workers)
+
+        self.counts["failed_users"] = failed
+        self.counts["rooms_not_ready"] = sum(1 for missing in self.missing.values() if missing)
+        elapsed = time.time() - start_time
+        print(f"Provisioned in {elapsed:0.1f}s: "
+              f"{self.counts['users'] / elapsed if elapsed else 0:0.1f} users/s, "
+              f"{self.counts['rooms'] / elapsed if elapsed else 0:0.1f} rooms/s, "
+              f"{self.counts['invites'] / elapsed if elapsed else 0:0.1f} invites/s, "
+              f"{self.counts['joins'] / elapsed if elapsed else 0:0.1f} joins/s: {self.counts}")
+        return self.counts
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Registers users, creates rooms, invites and joins in one pipeline")
+    parser.add_argument("-c", "--concurrency", type=int, default=config.CONCURRENCY,
+                        help="Workers per stage")
+    parser.add_argument("-q", "--queue-size", type=int, default=1000,
+                        help="Max items waiting between two stages")
+    parser.add_argument("-b", "--backend", choices=["client", "admin"], default="client",
+                        help="Registration backend, see register_user.py")
+    args = parser.parse_args()
+
+    with open(config.ROOMS_JSON, "r", encoding="utf-8") as rooms_jsonfile:
+        rooms = json.load(rooms_jsonfile)
+    synapse = SynapseClient(config.BASE_URL)
+    pipeline = ProvisioningPipeline(synapse, rooms, config.OUTPUT_CSV, concurrency=args.concurrency,
+                                    queue_size=args.queue_size, backend=args.backend)
+    await pipeline.run(iter_users(config.INPUT_CSV))
+
+    # Close the async client
+    await synapse.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Token bucket that hands out `rate` tokens per second with bursts of up to `burst`.
+
+    Callers reserve a token immediately and then sleep until it is paid off,
+    so waiters are served in arrival order and each acquire is O(1).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def reserve(self, tokens=1):
+        """Take `tokens` and return how many seconds the caller must wait for them."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= tokens
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    async def acquire(self, tokens=1):
+        """Wait until `tokens` are available."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def _bucket(limit):
+    """Build a TokenBucket from a {"rate": ..., "burst": ...} dict, or None."""
+    if not limit:
+        return None
+    return TokenBucket(limit["rate"], limit.get("burst"))
+
+
+def split_limits(limits, parts):
+    """Copy of a config.RATE_LIMITS-shaped dict with the shared limits split `parts` ways.
+
+    The global and per-endpoint limits are shared by every process of a run,
+    so each of `parts` processes gets 1/parts of their rate and burst.
+    Per-user limits are kept: each user runs in only one process.
+    """
+    def _split(limit):
+        if not limit:
+            return limit
+        limit = dict(limit, rate=limit["rate"] / parts)
+        if limit.get("burst") is not None:
+            limit["burst"] = max(1.0, limit["burst"] / parts)
+        return limit
+
+    limits = dict(limits or {})
+    limits["global"] = _split(limits.get("global"))
+    limits["endpoint"] = {family: _split(limit)
+                          for family, limit in (limits.get("endpoint") or {}).items()}
+    return limits
+
+
+class RateLimiter:
+    """Client-side limits applied before every request.
+
+    A request must get a token from every bucket that applies to it:
+    the global bucket, the bucket shared by all users for its endpoint
+    family, the per-user bucket and the per-user bucket for its endpoint
+    family. Each limit is a {"rate": requests_per_second, "burst": n} dict;
+    missing limits are not enforced.
+    """
+
+    def __init__(self, global_limit=None, user_limit=None, endpoint_limits=None,
+                 user_endpoint_limits=None):
+        self.global_bucket = _bucket(global_limit)
+        self.endpoint_buckets = {family: _bucket(limit)
+                                 for family, limit in (endpoint_limits or {}).items() if limit}
+        self.user_limit = user_limit
+        self.user_endpoint_limits = {family: limit
+                                     for family, limit in (user_endpoint_limits or {}).items() if limit}
+        self.user_buckets = {}
+
+    @classmethod
+    def from_config(cls, limits):
+        """Build a limiter from a dict shaped like config.RATE_LIMITS."""
+        limits = limits or {}
+        return cls(limits.get("global"), limits.get("user"),
+                   limits.get("endpoint"), limits.get("user_endpoint"))
+
+    def _user_bucket(self, user, family, limit):
+        key = (user, family)
+        bucket = self.user_buckets.get(key)
+        if bucket is None:
+            bucket = self.user_buckets[key] = _bucket(limit)
+        return bucket
+
+    def buckets(self, family, user=None):
+        """Return the buckets a request of `family` made by `user` must pass."""
+        buckets = [self.global_bucket, self.endpoint_buckets.get(family)]
+        if user is not None:
+            if self.user_limit:
+                buckets.append(self._user_bucket(user, None, self.user_limit))
+            limit = self.user_endpoint_limits.get(family)
+            if limit:
+                buckets.append(self._user_bucket(user, family, limit))
+        return [bucket for bucket in buckets if bucket is not None]
+
+    async def acquire(self, family, user=None):
+        """Wait until a request of `family` made by `user` may be sent."""
+        wait = 0.0
+        for bucket in self.buckets(family, user):
+            wait = max(wait, bucket.reserve())
+        if wait > 0:
+            await asyncio.sleep(wait)
@@ -1,14 +1,16 @@
 import asyncio
 from synapse_client import SynapseClient
+from user_registry import UserRegistry
 import config
 
 
 async def main():
     synapse = SynapseClient(config.BASE_URL)
+    users = UserRegistry(config.REGISTERED_USERS_CSV)
 
     # Register users from CSV and store user IDs and access tokens
-    #await synapse.create_rooms_from_csv(config.REGISTERED_USERS_CSV, config.ROOMS_JSON)
-    await synapse.create_dm_rooms(config.REGISTERED_USERS_CSV)
+    #await synapse.create_rooms_from_csv(users, config.ROOMS_JSON, concurrency=config.CONCURRENCY)
+    await synapse.create_dm_rooms(users)
 
     # Close the async client
     await synapse.close()
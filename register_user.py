@@ -1,13 +1,24 @@
+import argparse
 import asyncio
 from synapse_client import SynapseClient
 import config
 
 
 async def main():
+    parser = argparse.ArgumentParser(description="Registers the users from config.INPUT_CSV")
+    parser.add_argument("-c", "--concurrency", type=int, default=config.CONCURRENCY,
+                        help="Max number of users registered at the same time")
+    parser.add_argument("-b", "--backend", choices=["client", "admin"], default="client",
+                        help="client: /register with m.login.dummy (rate limited); admin: shared-secret "
+                             "admin registration, needs config.REGISTRATION_SHARED_SECRET")
+    args = parser.parse_args()
+
     synapse = SynapseClient(config.BASE_URL)
 
-    # Register users from CSV and store user IDs and access tokens
-    await synapse.register_users_from_csv(config.INPUT_CSV, config.OUTPUT_CSV)
+    # Register users from CSV and store user IDs and access tokens;
+    # users already in config.OUTPUT_CSV are skipped, so an interrupted run can be repeated
+    await synapse.register_users_from_csv(config.INPUT_CSV, config.OUTPUT_CSV,
+                                          concurrency=args.concurrency, backend=args.backend)
 
     # Close the async client
     await synapse.close()  
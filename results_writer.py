@@ -0,0 +1,255 @@
+import csv
+import glob
+import gzip
+import os
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for the columnar formats
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for the parquet format
+    pa = None
+    pq = None
+
+
+# Fixed schema of one per-request result row: (column name, type)
+RESULT_FIELDS = (
+    ("timestamp", float),  # Intended start time (unix seconds)
+    ("agent", str),
+    ("username", str),
+    ("room_id", str),
+    ("status", int),
+    ("msg_size", int),
+    ("latency", float),  # Seconds from intended start to response
+    ("is_whatsapp", bool),
+    ("operation", str),  # Read / Write / ...
+    ("start_lag", float),  # Seconds between intended and actual start
+)
+RESULT_COLUMNS = [name for name, _ in RESULT_FIELDS]
+
+# Storage type of each column in the columnar formats; "dict" columns are
+# dictionary-encoded (int32 codes plus the list of distinct values).
+COLUMNAR_TYPES = {
+    "timestamp": "int64",  # Nanoseconds
+    "agent": "dict",
+    "username": "dict",
+    "room_id": "dict",
+    "status": "int16",
+    "msg_size": "int32",
+    "latency": "float32",
+    "is_whatsapp": "bool",
+    "operation": "dict",
+    "start_lag": "float32",
+}
+
+
+def open_results(filename, mode="r"):
+    """Open a results CSV as text, transparently handling .gz compression."""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode + "t", encoding="utf-8", newline="", compresslevel=1)
+    return open(filename, mode, encoding="utf-8", newline="")
+
+
+class ResultsWriter:
+    """Buffered per-request results sink.
+
+    `write` only appends a tuple to an in-memory batch; a background thread
+    flushes batches to disk every `flush_interval` seconds or as soon as
+    `flush_rows` rows are pending, so the event loop never waits on file I/O.
+    Files ending in .gz are gzip-compressed.
+    """
+
+    def __init__(self, filename, flush_rows=10000, flush_interval=1.0):
+        self.filename = filename
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.file = self._open()
+        self._write_header()
+        self.thread = threading.Thread(target=self._run, name="results-writer", daemon=True)
+        self.thread.start()
+
+    def _open(self):
+        return open_results(self.filename, "w")
+
+    def _write_header(self):
+        csv.writer(self.file).writerow(RESULT_COLUMNS)
+
+    def write(self, *row):
+        """Queue one row with the values of RESULT_FIELDS, in order."""
+        with self.lock:
+            self.rows.append(row)
+            pending = len(self.rows)
+        if pending >= self.flush_rows:
+            self.wakeup.set()
+
+    def _take(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+        return rows
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            rows = self._take()
+            if rows:
+                self._write_batch(rows)
+
+    def _write_batch(self, rows):
+        csv.writer(self.file).writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        """Flush pending rows and close the file."""
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        rows = self._take()
+        if rows:
+            self._write_batch(rows)
+        if self.file is not None:
+            self.file.close()
+
+
+class ColumnarResultsWriter(ResultsWriter):
+    """Results sink that stores each flushed batch in a compact columnar format.
+
+    format="npz" writes one NumPy .npz file per batch into the `filename`
+    directory; format="parquet" appends one row group per batch to a single
+    Parquet file (needs pyarrow). Timestamps are int64 nanoseconds, status
+    codes int16, latencies float32, and string columns are dictionary-encoded.
+    Use `load_results` to read either format back.
+    """
+
+    def __init__(self, filename, format="npz", compress=False, flush_rows=100000,
+                 flush_interval=5.0):
+        if np is None:
+            raise RuntimeError("numpy is required for columnar results")
+        if format == "parquet" and pa is None:
+            raise RuntimeError("pyarrow is required for parquet results")
+        self.format = format
+        self.compress = compress
+        self.parts = 0
+        self.parquet_writer = None
+        super().__init__(filename, flush_rows=flush_rows, flush_interval=flush_interval)
+
+    def _open(self):
+        if self.format == "npz":
+            os.makedirs(self.filename, exist_ok=True)
+        return None
+
+    def _write_header(self):
+        pass
+
+    def _columns(self, rows):
+        """Convert a batch of row tuples into {column: array} and {column: dictionary}."""
+        columns = {}
+        dictionaries = {}
+        for position, name in enumerate(RESULT_COLUMNS):
+            values = [row[position] for row in rows]
+            kind = COLUMNAR_TYPES[name]
+            if kind == "dict":
+                index = {}
+                codes = [index.setdefault(value, len(index)) for value in values]
+                columns[name] = np.array(codes, dtype=np.int32)
+                dictionaries[name] = np.array(list(index), dtype=str)
+            elif name == "timestamp":
+                columns[name] = (np.array(values, dtype=np.float64) * 1e9).astype(np.int64)
+            else:
+                columns[name] = np.array(values, dtype=kind)
+        return columns, dictionaries
+
+    def _write_batch(self, rows):
+        columns, dictionaries = self._columns(rows)
+        if self.format == "npz":
+            arrays = dict(columns)
+            arrays.update({name + ".dictionary": values for name, values in dictionaries.items()})
+            path = os.path.join(self.filename, f"part-{self.parts:05d}.npz")
+            (np.savez_compressed if self.compress else np.savez)(path, **arrays)
+        else:
+            arrays = [pa.DictionaryArray.from_arrays(columns[name], dictionaries[name])
+                      if name in dictionaries else pa.array(columns[name])
+                      for name in RESULT_COLUMNS]
+            table = pa.Table.from_arrays(arrays, names=RESULT_COLUMNS)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(
+                    self.filename, table.schema, compression="zstd" if self.compress else "none")
+            self.parquet_writer.write_table(table)
+        self.parts += 1
+
+    def close(self):
+        super().close()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def iter_results(path, batch_rows=1000000):
+    """Yield columnar results one part (npz) or record batch (parquet) at a time.
+
+    Each item has the same layout as `load_results`, with dictionaries local
+    to that item, so arbitrarily large runs can be processed in bounded memory.
+    """
+    if np is None:
+        raise RuntimeError("numpy is required for columnar results")
+    if path.endswith(".parquet"):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows):
+            result = {}
+            for name, column in zip(batch.schema.names, batch.columns):
+                if COLUMNAR_TYPES.get(name) == "dict":
+                    result[name] = column.indices.to_numpy().astype(np.int32)
+                    result[name + ".dictionary"] = np.array(column.dictionary.to_pylist(), dtype=str)
+                else:
+                    result[name] = column.to_numpy(zero_copy_only=False)
+            yield result
+        return
+    for part in sorted(glob.glob(os.path.join(path, "part-*.npz"))):
+        with np.load(part) as arrays:
+            yield {name: arrays[name] for name in arrays.files}
+
+
+def load_results(path):
+    """Load columnar results (an npz directory or a Parquet file) into NumPy arrays.
+
+    Returns {column: array}; dictionary-encoded columns come back as int32
+    codes in `column` plus the distinct values in `column + ".dictionary"`.
+    """
+    if np is None:
+        raise RuntimeError("numpy is required for columnar results")
+    if path.endswith(".parquet"):
+        table = pq.read_table(path)
+        result = {}
+        for name in table.column_names:
+            column = table.column(name)
+            if COLUMNAR_TYPES.get(name) == "dict":
+                column = column.unify_dictionaries().combine_chunks()
+                result[name] = column.indices.to_numpy().astype(np.int32)
+                result[name + ".dictionary"] = np.array(column.dictionary.to_pylist(), dtype=str)
+            else:
+                result[name] = column.to_numpy()
+        return result
+
+    parts = [np.load(part) for part in sorted(glob.glob(os.path.join(path, "part-*.npz")))]
+    result = {}
+    for name in RESULT_COLUMNS:
+        if COLUMNAR_TYPES[name] != "dict":
+            result[name] = np.concatenate([part[name] for part in parts]) if parts else np.array([])
+            continue
+        # Re-map every part's local codes onto one dictionary for the whole run
+        index = {}
+        codes = []
+        for part in parts:
+            mapping = np.array([index.setdefault(value, len(index))
+                                for value in part[name + ".dictionary"].tolist()], dtype=np.int32)
+            codes.append(mapping[part[name]] if len(mapping) else part[name])
+        result[name] = np.concatenate(codes) if codes else np.array([], dtype=np.int32)
+        result[name + ".dictionary"] = np.array(list(index), dtype=str)
+    return result
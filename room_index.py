@@ -0,0 +1,96 @@
+import json
+import os
+
+
+# Classification flags of a room, set from its state events
+BRIDGE = 1  # Has an m.bridge state event
+WHATSAPP_MEMBER = 2  # Has a member event sent by a puppeted @whatsapp_ user
+WHATSAPP_BOT = 4  # Has a member event sent by the @whatsapp-mudita bot
+
+BRIDGED = "bridged"  # Bridged WhatsApp room
+NATIVE = "native"  # Plain Matrix room
+SKIPPED = "skipped"  # Bot management and half-bridged rooms, not used for load
+
+
+def room_type(flags):
+    """Category of a room with the given flags."""
+    if flags == BRIDGE | WHATSAPP_MEMBER | WHATSAPP_BOT:
+        return BRIDGED
+    if flags == 0:
+        return NATIVE
+    return SKIPPED
+
+
+def state_flags(state_events):
+    """Classification flags contributed by a list of state events."""
+    flags = 0
+    for event in state_events:
+        if event["type"] == "m.bridge":
+            flags |= BRIDGE
+        elif event["type"] == "m.room.member":
+            if event["sender"].startswith('@whatsapp_'):
+                flags |= WHATSAPP_MEMBER
+            if event["sender"].startswith('@whatsapp-mudita'):
+                flags |= WHATSAPP_BOT
+    return flags
+
+
+class RoomIndex:
+    """Classification of every room seen, keyed by room_id and shared by all users.
+
+    Flags only accumulate, so the index can be updated from the state deltas
+    of incremental syncs (and from several users seeing the same room)
+    without re-scanning full room state. The index is saved between runs.
+    """
+
+    def __init__(self, filename=None):
+        self.flags = {}  # room_id -> flags
+        self.members = {}  # room_id -> set of joined user ids
+        if filename and os.path.exists(filename):
+            with open(filename, mode="r", encoding="utf-8") as file:
+                for room_id, (flags, members) in json.load(file).items():
+                    self.flags[room_id] = flags
+                    self.members[room_id] = set(members)
+
+    def __contains__(self, room_id):
+        return room_id in self.flags
+
+    def __len__(self):
+        return len(self.flags)
+
+    def update(self, room_id, state_events):
+        """Apply the state events (full state or a delta) of a room."""
+        self.flags[room_id] = self.flags.get(room_id, 0) | state_flags(state_events)
+        members = self.members.setdefault(room_id, set())
+        for event in state_events:
+            if event["type"] == "m.room.member" and "state_key" in event:
+                membership = event.get("content", {}).get("membership")
+                if membership == "join":
+                    members.add(event["state_key"])
+                elif membership is not None:
+                    members.discard(event["state_key"])
+
+    def room_type(self, room_id):
+        """BRIDGED, NATIVE or SKIPPED, or None for rooms not indexed yet."""
+        flags = self.flags.get(room_id)
+        return None if flags is None else room_type(flags)
+
+    def whatsuapp_member(self, room_id):
+        return bool(self.flags.get(room_id, 0) & WHATSAPP_MEMBER)
+
+    def member_count(self, room_id):
+        return len(self.members.get(room_id, ()))
+
+    def merge(self, other):
+        """Add the classification of another index (e.g. from a worker process)."""
+        for room_id, flags in other.flags.items():
+            self.flags[room_id] = self.flags.get(room_id, 0) | flags
+            self.members.setdefault(room_id, set()).update(other.members.get(room_id, ()))
+
+    def save(self, filename):
+        """Write the index atomically."""
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, mode="w", encoding="utf-8") as file:
+            json.dump({room_id: [flags, sorted(self.members.get(room_id, ()))]
+                       for room_id, flags in self.flags.items()}, file)
+        os.replace(tmp_filename, filename)
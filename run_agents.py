@@ -0,0 +1,125 @@
+import asyncio
+import csv
+import multiprocessing
+import os
+import time
+import config
+import send_message
+from latency import LatencyRecorder
+from rate_limiter import split_limits
+from results_writer import open_results
+from sync_state import SyncTokenStore
+from room_index import RoomIndex
+from user_registry import iter_users, iter_shard
+
+
+def worker(index, args, barrier, results):
+    """Run one agent process over its shard of the registered users."""
+    users = iter_shard(iter_users(config.REGISTERED_USERS_CSV), index, args.workers)
+    agent = f"{args.agent}-w{index}"
+    # The first num_users % workers workers take one user more, so none is dropped
+    args.num_users = max(1, args.num_users // args.workers
+                         + (index < args.num_users % args.workers))
+    # Global and endpoint rate limits are shared by all workers; per-user ones are not
+    config.RATE_LIMITS = split_limits(config.RATE_LIMITS, args.workers)
+    if args.rate:
+        args.rate = args.rate / args.workers
+    if args.target_rate:
+        args.target_rate = args.target_rate / args.workers
+    if args.delivery_listeners:
+        args.delivery_listeners = max(1, args.delivery_listeners // args.workers)
+
+    async def ready():
+        # Block until every worker finished its setup, so load starts together
+        await asyncio.to_thread(barrier.wait)
+
+    try:
+        log_filename, summary, recorder = asyncio.run(send_message.run(
+            args, users, agent, ready=ready, save_suffix=f".{agent}"))
+        results.put((index, log_filename, summary, recorder))
+    except Exception as e:
+        print(f"Worker {index} failed: {e}")
+        barrier.abort()
+        results.put((index, None, {}, None))
+
+
+def merge_logs(log_filenames, output_filename):
+    """Concatenate the worker CSV logs into one file with a single header."""
+    with open_results(output_filename, "w") as output:
+        writer = csv.writer(output)
+        for idx, log_filename in enumerate(log_filenames):
+            with open_results(log_filename, "r") as file:
+                reader = csv.reader(file)
+                header = next(reader, None)
+                if idx == 0 and header:
+                    writer.writerow(header)
+                writer.writerows(reader)
+
+
+def merge_summaries(summaries):
+    """Sum worker summaries; `max_*` entries take the maximum instead."""
+    merged = {}
+    for summary in summaries:
+        for key, value in summary.items():
+            if key.startswith("max_"):
+                merged[key] = max(merged.get(key, value), value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def main():
+    parser = send_message.build_parser()
+    parser.description = "Runs send_message.py load in several worker processes"
+    parser.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(args.workers)
+    results = ctx.Queue()
+    processes = [ctx.Process(target=worker, args=(index, args, barrier, results))
+                 for index in range(args.workers)]
+    start_time = time.time()
+    for process in processes:
+        process.start()
+    worker_results = sorted((results.get() for _ in processes), key=lambda result: result[0])
+    for process in processes:
+        process.join()
+    elapsed = time.time() - start_time
+
+    run_name = args.agent + "_" + time.strftime("%Y%m%d-%H%M%S")
+    # Every worker saved the sync tokens and room index of its own shard, combine them
+    sync_store = SyncTokenStore(args.sync_store)
+    room_index = RoomIndex(args.room_index)
+    for index in range(args.workers):
+        suffix = f".{args.agent}-w{index}"
+        if os.path.exists(args.sync_store + suffix):
+            sync_store.merge(SyncTokenStore(args.sync_store + suffix))
+            os.remove(args.sync_store + suffix)
+        if os.path.exists(args.room_index + suffix):
+            room_index.merge(RoomIndex(args.room_index + suffix))
+            os.remove(args.room_index + suffix)
+    sync_store.save(args.sync_store)
+    room_index.save(args.room_index)
+    print(f"{args.workers} workers finished in {elapsed:0.1f}s")
+    log_filenames = [log_filename for _, log_filename, _, _ in worker_results if log_filename]
+    if log_filenames and args.raw_format == "csv":
+        output_filename = run_name + (".csv.gz" if args.compress else ".csv")
+        merge_logs(log_filenames, output_filename)
+        print(f"Merged log: {output_filename}")
+    elif log_filenames:
+        # Columnar logs are read together by analyze_results.py, no need to copy them
+        print(f"Worker logs: {' '.join(log_filenames)}")
+    print(merge_summaries(summary for _, _, summary, _ in worker_results))
+
+    recorder = LatencyRecorder()
+    for _, _, _, worker_recorder in worker_results:
+        if worker_recorder is not None:
+            recorder.merge(worker_recorder)
+    print(f"Merged latency summary (also in {run_name}.hist.jsonl):")
+    recorder.write_snapshot(run_name + ".hist.jsonl")
+
+
+if __name__ == "__main__":
+    main()
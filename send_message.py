@@ -1,12 +1,29 @@
 import asyncio
+import random
 import time
 from synapse_client import SynapseClient
+from rate_limiter import RateLimiter
+from latency import LatencyRecorder
+from results_writer import ResultsWriter, ColumnarResultsWriter
+from sync_state import SyncTokenStore
+from room_index import RoomIndex
+from delivery import DeliveryTracker
+from user_registry import iter_users
 import config
 import helper
 import argparse
 
 
-async def main():
+def positive_float(value):
+    """argparse type for options that must be greater than zero."""
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0, got {value}")
+    return number
+
+
+def build_parser():
+    """Command line arguments shared by send_message.py and run_agents.py."""
     parser = argparse.ArgumentParser(
         description="Generates messages by users ")
     parser.add_argument("num_users", type=int, default=200, nargs="?",
@@ -14,23 +31,143 @@ async def main():
 
     parser.add_argument("-a", "--agent", type=str, default="agent1", nargs="?",
                         help="Agent Name")
-    args = parser.parse_args()
+    parser.add_argument("-c", "--concurrency", type=int, default=config.CONCURRENCY,
+                        help="Max number of virtual users running at the same time")
+    parser.add_argument("-r", "--rate", type=float, default=None,
+                        help="Global request rate limit (requests/s), overrides config.RATE_LIMITS")
+    parser.add_argument("-u", "--user-rate", type=float, default=None,
+                        help="Per-user request rate limit (requests/s), overrides config.RATE_LIMITS")
+    parser.add_argument("-m", "--mode", choices=["closed", "open"], default="closed",
+                        help="closed: each user sends as fast as responses return; "
+                             "open: sends are scheduled at --target-rate regardless of responses")
+    parser.add_argument("--target-rate", type=positive_float, default=10.0,
+                        help="Open-loop offered load (messages/s)")
+    parser.add_argument("--duration", type=positive_float, default=60.0,
+                        help="Open-loop run duration (s)")
+    parser.add_argument("--arrival", choices=["constant", "poisson"], default="constant",
+                        help="Open-loop inter-arrival distribution")
+    parser.add_argument("--raw-log", action="store_true",
+                        help="Also write one CSV row per request")
+    parser.add_argument("--raw-format", choices=["csv", "npz", "parquet"], default="csv",
+                        help="Raw log format: csv, npz (directory of NumPy parts) or parquet")
+    parser.add_argument("--compress", action="store_true",
+                        help="Compress the raw per-request log")
+    parser.add_argument("--snapshot-interval", type=float, default=10.0,
+                        help="Seconds between latency histogram snapshots")
+    parser.add_argument("--sync", choices=["cold", "warm"], default="cold",
+                        help="cold: start every user with an initial /sync; warm: continue "
+                             "from the since-tokens saved by the previous run")
+    parser.add_argument("--sync-store", type=str, default=config.SYNC_TOKENS_JSON,
+                        help="File the per-user since-tokens are loaded from and saved to")
+    parser.add_argument("--room-index", type=str, default=config.ROOM_INDEX_JSON,
+                        help="File the room classification index is loaded from and saved to")
+    parser.add_argument("-W", "--workload", choices=["messages", "history"], default="messages",
+                        help="messages: read and send messages; history: page through the "
+                             "whole history of every joined room")
+    parser.add_argument("--page-size", type=int, default=config.HISTORY_PAGE_SIZE,
+                        help="History workload: events per /messages page")
+    parser.add_argument("--direction", choices=["b", "f"], default="b",
+                        help="History workload: b scrolls back from the newest event, "
+                             "f reads forward from the room creation")
+    parser.add_argument("--max-pages", type=int, default=None,
+                        help="History workload: stop each room after this many pages")
+    parser.add_argument("--delivery-listeners", type=int, default=0,
+                        help="Number of users that long-poll /sync to measure send-to-delivery "
+                             "latency per room size (0: off)")
+    return parser
+
 
-    users = helper.get_users_from_csv(config.REGISTERED_USERS_CSV)
-    n = args.num_users/(len(users))
+async def run(args, users, agent, ready=None, save_suffix=""):
+    """Run the load for one agent over `args.num_users` users sampled from `users`.
 
-    users_set = helper.select_random_n_percent(users, n)
+    Returns (raw log filename or None, summary, latency recorder).
+
+    `users` is any iterable of UserRecords (e.g. user_registry.iter_users);
+    it is reservoir-sampled, so only the selected users are kept in memory.
+
+    `ready` is an optional coroutine function awaited right before load
+    starts, used by run_agents.py to start all worker processes together.
+    Sync tokens and the room index are saved to --sync-store and
+    --room-index with `save_suffix` appended; with a suffix only the sync
+    tokens of this run's users are saved, so merging the files of several
+    workers never overwrites fresh tokens with stale ones.
+    """
+    users_set = helper.reservoir_sample(users, args.num_users)
     # users_set = users[:5]
-    log_filename = args.agent + "_" + time.strftime("%Y%m%d-%H%M%S") + ".csv"
-    logger = helper.setup_logger(log_filename)
+    run_name = agent + "_" + time.strftime("%Y%m%d-%H%M%S")
+    log_filename = None
+    results = None
+    if args.raw_log and args.raw_format == "csv":
+        log_filename = run_name + (".csv.gz" if args.compress else ".csv")
+        results = ResultsWriter(log_filename)
+    elif args.raw_log:
+        log_filename = run_name + (".results" if args.raw_format == "npz" else ".parquet")
+        results = ColumnarResultsWriter(log_filename, format=args.raw_format,
+                                        compress=args.compress)
+    recorder = LatencyRecorder()
+    sync_store = SyncTokenStore(args.sync_store if args.sync == "warm" else None)
+    room_index = RoomIndex(args.room_index)
+    delivery = DeliveryTracker() if args.delivery_listeners else None
+
+    rate_limits = dict(config.RATE_LIMITS)
+    if args.rate:
+        rate_limits["global"] = {"rate": args.rate}
+    if args.user_rate:
+        rate_limits["user"] = {"rate": args.user_rate}
 
     # Register users from CSV and store user IDs and access tokens
-    synapse = SynapseClient(config.BASE_URL, logger=logger, agent=args.agent)
+    synapse = SynapseClient(config.BASE_URL, results=results, agent=agent,
+                            rate_limiter=RateLimiter.from_config(rate_limits),
+                            recorder=recorder, sync_store=sync_store, room_index=room_index,
+                            delivery=delivery)
+    snapshot_filename = run_name + ".hist.jsonl"
+    snapshots = asyncio.create_task(
+        recorder.run_snapshots(args.snapshot_interval, snapshot_filename))
+    listeners = []
+    if delivery is not None:
+        listeners = await synapse.start_delivery_listeners(
+            random.sample(users_set, min(args.delivery_listeners, len(users_set))),
+            concurrency=args.concurrency)
 
-    await synapse.send_message_gen(users_set, helper.message_set)
+    if args.workload == "history":
+        if ready:
+            await ready()
+        summary = await synapse.read_history_gen(users_set, concurrency=args.concurrency,
+                                                 direction=args.direction,
+                                                 page_size=args.page_size,
+                                                 max_pages=args.max_pages)
+    elif args.mode == "open":
+        summary = await synapse.send_message_open_loop(users_set, helper.message_set, args.target_rate,
+                                                       args.duration, arrival=args.arrival,
+                                                       concurrency=args.concurrency, ready=ready)
+    else:
+        if ready:
+            await ready()
+        summary = await synapse.send_message_gen(users_set, helper.message_set,
+                                                 concurrency=args.concurrency)
+    if delivery is not None:
+        summary.update(await synapse.stop_delivery_listeners(listeners))
+
+    snapshots.cancel()
+    print(f"Latency summary for {agent} (also in {snapshot_filename}):")
+    recorder.write_snapshot(snapshot_filename)
+
+    if results is not None:
+        results.close()
+    sync_store.save(args.sync_store + save_suffix, touched_only=bool(save_suffix))
+    room_index.save(args.room_index + save_suffix)
 
     # Close the async client
     await synapse.close()
+    return log_filename, summary, recorder
+
+
+async def main():
+    args = build_parser().parse_args()
+    users = iter_users(config.REGISTERED_USERS_CSV)
+    await run(args, users, args.agent)
+
 
-# Run the async program
-asyncio.run(main())
+if __name__ == "__main__":
+    # Run the async program
+    asyncio.run(main())
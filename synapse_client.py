@@ -1,6 +1,13 @@
 from matrix_api import MatrixAPI
+from room_index import RoomIndex
+from sync_state import SyncTokenStore, SyncParser, sync_filter, ROOM_LIST_FILTER
+from delivery import MARKER, room_size_bucket
+from user_registry import UserRegistry, iter_users, normalize_user_id
 import uuid
 import csv
+import hashlib
+import hmac
+import os
 import asyncio
 import json
 import random
@@ -11,11 +18,29 @@ import functools
 import time
 
 
+def device_id(username):
+    """Stable device id of a test user, so logins reuse one device instead of adding more."""
+    return config.DEVICE_ID_PREFIX + username
+
+
 class SynapseClient(MatrixAPI):
-    def __init__(self, base_url, logger=None, agent=None):
-        super().__init__(base_url)
-        self.logger = logger
+    def __init__(self, base_url, results=None, agent=None, client=None, rate_limiter=None,
+                 recorder=None, sync_store=None, room_index=None, delivery=None):
+        super().__init__(base_url, client=client, rate_limiter=rate_limiter)
+        self.results = results
         self.agent = agent
+        self.recorder = recorder
+        self.sync_store = sync_store if sync_store is not None else SyncTokenStore()
+        self.room_index = room_index if room_index is not None else RoomIndex()
+        self.delivery = delivery  # delivery.DeliveryTracker when measuring delivery latency
+        self.filter_ids = {}  # (user_id, filter JSON) -> filter_id, shared by all sessions
+        self.load_filter = sync_filter(timeline_limit=config.SYNC_TIMELINE_LIMIT,
+                                       lazy_load_members=config.SYNC_LAZY_LOAD_MEMBERS)
+        self.delivery_filter = sync_filter(timeline_limit=config.DELIVERY_TIMELINE_LIMIT)
+
+    def user_session(self, user):
+        """Session (see as_user) acting as a user_registry.UserRecord."""
+        return self.as_user(user.access_token, username=user.username, user_id=user.user_id)
 
     async def register_user(self, username, password):
         """Register a new user using m.login.dummy authentication."""
@@ -24,22 +49,106 @@ class SynapseClient(MatrixAPI):
             "auth": {"type": "m.login.dummy"},
             "username": username,
             "password": password,
+            "device_id": device_id(username),
+        }
+        return await self._request("POST", endpoint, data)
+
+    async def admin_register_user(self, username, password, admin=False):
+        """Register a new user with Synapse's shared-secret admin registration.
+
+        Not subject to the client registration rate limits. Needs
+        config.REGISTRATION_SHARED_SECRET; a fresh nonce is fetched per user.
+        """
+        if not config.REGISTRATION_SHARED_SECRET:
+            raise RuntimeError("config.REGISTRATION_SHARED_SECRET is not set")
+        endpoint = "/_synapse/admin/v1/register"
+        response = await self._request("GET", endpoint)
+        if response.status_code != 200:
+            return response
+        nonce = response.json()["nonce"]
+        mac = hmac.new(config.REGISTRATION_SHARED_SECRET.encode("utf8"), digestmod=hashlib.sha1)
+        mac.update(b"\x00".join([nonce.encode("utf8"), username.encode("utf8"),
+                                  password.encode("utf8"), b"admin" if admin else b"notadmin"]))
+        data = {
+            "nonce": nonce,
+            "username": username,
+            "password": password,
+            "admin": admin,
+            "mac": mac.hexdigest(),
         }
         return await self._request("POST", endpoint, data)
 
     async def login(self, username, password):
-        """Log in and set the access token."""
+        """Log in; use `as_user` with the returned access token to act as that user.
+
+        Always logs in as the user's stable device (see device_id), which
+        replaces the device's previous token instead of creating a new device.
+        """
         endpoint = "/_matrix/client/v3/login"
         data = {
             "type": "m.login.password",
             "user": username,
-            "password": password
+            "password": password,
+            "device_id": device_id(username),
         }
-        ret = await self._request("POST", endpoint, data)
-        if ret.status_code == 200:
-            response = ret.json()
-            self.set_access_token(response["access_token"])
-        return ret
+        return await self._request("POST", endpoint, data)
+
+    async def admin_session(self):
+        """Return a session authenticated as the server admin.
+
+        Uses config.ADMIN_ACCESS_TOKEN, or logs in as config.ADMIN_USERNAME.
+        """
+        access_token = config.ADMIN_ACCESS_TOKEN
+        if not access_token:
+            response = await self.login(config.ADMIN_USERNAME, config.ADMIN_PASSWORD)
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to login as admin. Response: {response.status_code}")
+            access_token = response.json()["access_token"]
+        return self.as_user(access_token, username=config.ADMIN_USERNAME)
+
+    async def admin_login_as(self, user_id, valid_until_ms=None):
+        """Mint an access token for `user_id` with the admin "login as user" API.
+
+        Must be called on an admin session (see admin_session).
+        """
+        endpoint = f"/_synapse/admin/v1/users/{user_id}/login"
+        data = {"valid_until_ms": valid_until_ms} if valid_until_ms else {}
+        response = await self._request("POST", endpoint, data)
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to get a token for {user_id}. Response: {response.status_code}")
+        return response.json()["access_token"]
+
+    async def whoami(self):
+        """Return the user_id the session's access token belongs to, or None."""
+        endpoint = "/_matrix/client/v3/account/whoami"
+        response = await self._request("GET", endpoint)
+        if response.status_code != 200:
+            return None
+        return response.json().get("user_id")
+
+    async def get_filter_id(self, definition):
+        """Upload a filter definition once per user and return its filter_id.
+
+        Returns None if the filter could not be created; callers then sync
+        without a filter.
+        """
+        user_id = self.user_id
+        if not user_id:
+            user_id = self.user_id = await self.whoami()
+        if not user_id:
+            return None
+        if not user_id.startswith("@"):
+            user_id = "@" + user_id
+        key = (user_id, json.dumps(definition, sort_keys=True))
+        filter_id = self.filter_ids.get(key)
+        if filter_id is None:
+            endpoint = f"/_matrix/client/v3/user/{user_id}/filter"
+            response = await self._request("POST", endpoint, definition)
+            if response.status_code != 200:
+                print("❌ Error creating filter:", response.status_code)
+                return None
+            filter_id = self.filter_ids[key] = response.json()["filter_id"]
+        return filter_id
 
     async def list_users(self):
         """Get all users (Admin API)."""
@@ -59,19 +168,7 @@ class SynapseClient(MatrixAPI):
             "preset": "private_chat",
             "invite": [invite_user]
         }
-        delay = 1
-        retries = 5
-        for i in range(retries):
-            response = await self._request("POST", endpoint, data)
-            if response.status_code == 200:
-                return response
-            if response.status_code == 429:
-                print(f"Rate limited, retrying in {delay} seconds...")
-                await asyncio.sleep(delay)
-                delay *= 2
-            else:
-                break
-        return response
+        return await self._request("POST", endpoint, data)
 
     async def create_room(self, room_name, invite_users=[]):
         """Create a new room."""
@@ -81,101 +178,151 @@ class SynapseClient(MatrixAPI):
             "preset": "private_chat",
             "invite": invite_users
         }
-        delay = 1
-        retries = 5
-        for i in range(retries):
-            response = await self._request("POST", endpoint, data)
-            if response.status_code == 200:
-                return response
-            if response.status_code == 429:
-                print(f"Rate limited, retrying in {delay} seconds...")
-                await asyncio.sleep(delay)
-                delay *= 2
-            else:
-                break
-        return None
+        return await self._request("POST", endpoint, data)
+
+    async def create_room_with_members(self, room_name, user_ids,
+                                       chunk_size=config.CREATE_ROOM_INVITE_CHUNK):
+        """Create a room and invite `user_ids` with as few requests as possible.
+
+        The first `chunk_size` members are invited by createRoom itself; for
+        bigger rooms the rest are invited `chunk_size` concurrent /invite
+        requests at a time. Returns (createRoom response, invited user ids,
+        number of failed invites).
+        """
+        response = await self.create_room(room_name, invite_users=list(user_ids[:chunk_size]))
+        if response.status_code != 200:
+            return response, [], 0
+        room_id = response.json()["room_id"]
+        invited = list(user_ids[:chunk_size])
+        failed = 0
+        for start in range(chunk_size, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            results = await asyncio.gather(*(self.invite_users(room_id, user_id) for user_id in chunk))
+            for user_id, result in zip(chunk, results):
+                if result.status_code == 200:
+                    invited.append(user_id)
+                else:
+                    failed += 1
+        return response, invited, failed
 
     async def invite_users(self, room_id, user):
         endpoint = f"/_matrix/client/v3/rooms/{room_id}/invite"
         data = {"user_id": user}
-        delay = 1
-        retries = 5
-        for i in range(retries):
-            response = await self._request("POST", endpoint, data)
-            if response.status_code == 200:
-                return response
-            if response.status_code == 429:
-                print(f"Rate limited, retrying in {delay} seconds...")
-                await asyncio.sleep(delay)
-                delay *= 2
-            else:
-                break
-        return None
+        return await self._request("POST", endpoint, data)
+
+    def _log_request(self, username, room_id, status_code, msg_size, start_time,
+                     whatsuapp_room, rw, intended_start=None):
+        """Record one request in the latency recorder and, if enabled, the results writer.
 
-    async def send_message(self, room_id, message, username, whatsuapp_room):
+        With an `intended_start` (open-loop mode) latency is measured from the
+        scheduled start, so time spent waiting to be sent is included, and the
+        start lag (actual minus intended start) is recorded as well.
+        """
+        end_time = time.time()
+        if intended_start is None:
+            intended_start = start_time
+        execution_time = round(end_time - intended_start, 6)
+        start_lag = round(start_time - intended_start, 6)
+        if self.recorder is not None:
+            room_type = "whatsapp" if whatsuapp_room else "native"
+            self.recorder.record(rw, status_code, room_type, end_time - intended_start)
+            if start_lag:
+                self.recorder.record("StartLag", status_code, room_type, start_lag)
+        if self.results is not None:
+            self.results.write(round(intended_start, 6), self.agent, username, room_id, status_code,
+                               msg_size, execution_time, whatsuapp_room, rw, start_lag)
+
+    async def send_message(self, room_id, message, username, whatsuapp_room, intended_start=None):
         """Send a message to a room."""
 
         start_time = time.time()
         txn_id = str(uuid.uuid4())
         endpoint = f"/_matrix/client/v3/rooms/{room_id}/send/m.room.message/{txn_id}"
         data = {"msgtype": "m.text", "body": message}
-        delay = 1
-        retries = 5
         msg_size = len(message)
-        for i in range(retries):
-            response = await self._request("PUT", endpoint, data)
-            if response.status_code == 200:
-                end_time = time.time()
-                execution_time = round(end_time - start_time, 6)
-                log_entry = f"{start_time:0.0f}, {self.agent}, {username},{room_id},{response.status_code},{msg_size},{execution_time}, {whatsuapp_room}, 'Write'"
-                self.logger.info(log_entry)
-                return response.status_code
-            if response.status_code == 429:
-                print(f"Rate limited, retrying in {delay} seconds...")
-                await asyncio.sleep(delay)
-                delay *= 2
-            else:
-                end_time = time.time()
-                execution_time = round(end_time - start_time, 6)
-                log_entry = f"{start_time:0.0f}, {self.agent},{username},{room_id},{response.status_code},{msg_size},{execution_time}, {whatsuapp_room},'Write'"
-                self.logger.info(log_entry)
-                return response.status_code
-        end_time = time.time()
-        execution_time = round(end_time - start_time, 6)
-        log_entry = f"{start_time:0.0f}, {self.agent}, {username},{room_id},{response.status_code},{msg_size},{execution_time}, {whatsuapp_room},'Write'"
-        self.logger.info(log_entry)
+        tracked = self.delivery is not None and self.delivery.expect(
+            txn_id, room_id, intended_start if intended_start is not None else start_time, username)
+        if tracked:
+            data[MARKER] = txn_id
+        response = await self._request("PUT", endpoint, data)
+        if tracked:
+            self.delivery.sent(txn_id, response.json().get("event_id")
+                               if response.status_code == 200 else None)
+        self._log_request(username, room_id, response.status_code, msg_size, start_time,
+                          whatsuapp_room, "Write", intended_start)
         return response.status_code
-    
-    async def get_room_all_messages(self, room_id, username, whatsuapp_room):
+
+    async def sync(self, since=None, timeout=None, filter=None, parser=None):
+        """Make one /sync request.
+
+        `filter` is a filter definition (see sync_state.sync_filter), which is
+        registered through the filter API and referenced by its id. With a
+        `parser` (sync_state.SyncParser) the body is parsed while it streams in.
+        `timeout` is the long-poll timeout in milliseconds.
+        """
+        endpoint = "/_matrix/client/v3/sync"
+        params = {}
+        if since:
+            params["since"] = since
+        if timeout is not None:
+            params["timeout"] = timeout
+        if filter is not None:
+            filter_id = await self.get_filter_id(filter)
+            if filter_id is not None:
+                params["filter"] = filter_id
+        # Leave the server time to answer a long poll before the HTTP request times out
+        http_timeout = timeout / 1000 + 10 if timeout else None
+        return await self._request("GET", endpoint, params=params or None, parser=parser,
+                                   timeout=http_timeout)
+
+    async def get_sync_state(self, filter=None):
+        """Sync once and return the user's updated SyncState.
+
+        The state comes from the sync store, so the request is an incremental
+        sync whenever a since-token is known for this user. `filter` defaults
+        to the load filter (classification state plus recent messages).
+        """
+        start_time = time.time()
+        sync_state = self.sync_store.get(self.user_id or self.username or self.access_token)
+        operation = "Sync" if sync_state.next_batch is None else "IncrementalSync"
+        parser = SyncParser()
+        response = await self.sync(since=sync_state.next_batch,
+                                   filter=filter if filter is not None else self.load_filter,
+                                   parser=parser)
+        msg_size = parser.size if response.status_code == 200 else 0
+        self._log_request(self.username, "", response.status_code, msg_size, start_time,
+                          False, operation)
+        if response.status_code != 200:
+            print("❌ Error syncing:", response.status_code)
+            return sync_state
+        sync_state.update(parser.result(), self.room_index)
+        return sync_state
+
+    async def get_room_all_messages(self, room_id, username, whatsuapp_room, sync_state=None):
+        """Read a room: timeline from the user's sync plus newer events from /messages.
+
+        Without a `sync_state` a fresh /sync is made to get the starting token.
+        """
         start_time = time.time()
         messages = []
-        sync_endpoint = f"/_matrix/client/v3/sync?timeout=100"
-        delay = 1
-        retries = 5
-
-        for i in range(retries):
+        if sync_state is None:
+            sync_endpoint = "/_matrix/client/v3/sync?timeout=100"
             response = await self._request("GET", sync_endpoint)
-            if response.status_code == 200:
-                start_token = response.json()['next_batch']
-                break
-            if response.status_code == 429:
-                print(f"Rate limited, retrying in {delay} seconds...")
-                await asyncio.sleep(delay)
-                delay *= 2
-            else:
-                end_time = time.time()
-                execution_time = round(end_time - start_time, 6)
-                msg_size = sum(len(item) for item in messages)
-                log_entry = f"{start_time:0.0f}, {self.agent}, {username},{room_id},{response.status_code},{msg_size},{execution_time}, {whatsuapp_room}, 'Read'"
-                self.logger.info(log_entry)
-                return len(messages)        
-        
-        next_token = start_token
-       
+            if response.status_code != 200:
+                self._log_request(username, room_id, response.status_code, 0, start_time,
+                                  whatsuapp_room, "Read")
+                return len(messages)
+            next_token = response.json()['next_batch']
+        else:
+            next_token = sync_state.next_batch
+            messages.extend(sync_state.timelines.get(room_id, []))
+        status_code = 200
+
         if next_token:
             endpoint = f"/_matrix/client/v3/rooms/{room_id}/messages"
             params = {"from": next_token, "limit": 100, "dir": 'f'}
-            response = await self._request("GET", endpoint, params)
+            response = await self._request("GET", endpoint, params=params)
+            status_code = response.status_code
             if response.status_code == 200:
                 data = response.json()
                 chunk = data.get("chunk", [])
@@ -183,223 +330,366 @@ class SynapseClient(MatrixAPI):
                 next_token = data.get("end", None)
             else:
                 print("❌ Error fetching messages:", response.status_code)
+                self._log_request(username, room_id, response.status_code, 0, start_time,
+                                  whatsuapp_room, "Read")
                 return 0
-        end_time = time.time()
-        execution_time = round(end_time - start_time, 6)
         msg_size = sum(len(item) for item in messages)
-        log_entry = f"{start_time:0.0f}, {self.agent}, {username},{room_id},{response.status_code},{msg_size},{execution_time}, {whatsuapp_room}, 'Read'"
-        self.logger.info(log_entry)
+        self._log_request(username, room_id, status_code, msg_size, start_time,
+                          whatsuapp_room, "Read")
         return len(messages)
-        
-    async def  send_message_gen(self, users, message_set):
-
-        for user in tqdm(users):
-            access_token = user["access_token"]
-            username = user["username"]
-
-            self.set_access_token(access_token)
-            list_my_room_id = await self.get_my_rooms()
-            # read all messages from user's room_id
-            
-            for item in (list_my_room_id):
-                room_id = item['room_id']
-                whatsuapp_room = item['whatsuapp_member']
-                ret = await self.get_room_all_messages(room_id, username, whatsuapp_room)
-
-
-            for item in (list_my_room_id):
-                room_id = item['room_id']
-                whatsuapp_room = item['whatsuapp_member']
-                for i in range(1, random.randint(2, 10)):
-                    random_message = str(i)+' - '+ random.choice(message_set)
-                    ret = await self.send_message(room_id, random_message, username, whatsuapp_room)
-
-    async def register_users_from_csv(self, input_csv, output_csv):
-        """Read users from CSV, register them, and save their credentials."""
-        try:
-            with open(input_csv, mode="r", encoding="utf-8") as file:
-                reader = csv.DictReader(file)
-                users = list(reader)
-
-            with open(output_csv, mode="w", encoding="utf-8", newline="") as file:
-                writer = csv.writer(file)
-                writer.writerow(
-                    ["username", "user_id", "access_token"])  # Headers
-
-                for user in tqdm(users):
-                    username = user["username"]
-                    password = user["password"]
-                    response = await self.register_user(username, password)
-                    if response.status_code == 200:
-                        response = response.json()
-                        user_id = response["user_id"]
-
-                        # Log in to get access token
-                        login_response = await self.login(username, password)
-                        if login_response.status_code == 200:
-                            login_response = login_response.json()
-                            access_token = login_response["access_token"]
-
-                        # Save user_id and access_token
-                        writer.writerow([username, user_id, access_token])
-                        self.set_access_token("")
-                    elif response.status_code == 400:
-                        # Log in to get access token
-                        user_id = username+':'+config.DOMAIN
-                        print('User already exists, logging in', user_id)
-                        login_response = await self.login(username, password)
-                        if login_response.status_code == 200:
-                            login_response = login_response.json()
-                            access_token = login_response["access_token"]
-                        # Save user_id and access_token
-                        writer.writerow([username, user_id, access_token])
-                        self.set_access_token("")
 
-                    else:
-                        print(
-                            f"Failed to register {username}. Response: {response}")
+    async def iter_room_history(self, room_id, username, whatsuapp_room, direction="b",
+                                page_size=config.HISTORY_PAGE_SIZE, start=None, max_pages=None):
+        """Page through a room's timeline with /messages, yielding (status code, events) per page.
+
+        direction "b" scrolls back from `start` (default: the newest event),
+        "f" reads forward from `start` (default: the room creation). Every
+        page is logged as a "HistoryPage" request with its size in bytes.
+        Stops at the end of the timeline, after `max_pages`, or on an error,
+        after yielding the failing status code with no events.
+        """
+        endpoint = f"/_matrix/client/v3/rooms/{room_id}/messages"
+        token = start
+        pages = 0
+        while max_pages is None or pages < max_pages:
+            params = {"dir": direction, "limit": page_size}
+            if token:
+                params["from"] = token
+            start_time = time.time()
+            response = await self._request("GET", endpoint, params=params)
+            msg_size = len(response.content or b"") if response.status_code == 200 else 0
+            self._log_request(username, room_id, response.status_code, msg_size, start_time,
+                              whatsuapp_room, "HistoryPage")
+            if response.status_code != 200:
+                print("❌ Error fetching history:", response.status_code)
+                yield response.status_code, []
+                return
+            data = response.json()
+            chunk = data.get("chunk", [])
+            pages += 1
+            yield response.status_code, chunk
+            token = data.get("end")
+            if not chunk or not token:
+                return
+
+    async def read_room_history(self, room_id, username, whatsuapp_room, **kwargs):
+        """Read a room's whole history (see iter_room_history); returns (pages, events).
+
+        The time for the whole scrollback is logged as a "History" request,
+        with the number of events read as its size and the status code of
+        the failing page if the scrollback stopped on an error.
+        """
+        start_time = time.time()
+        pages = events = 0
+        status_code = 200
+        async for status_code, chunk in self.iter_room_history(room_id, username, whatsuapp_room,
+                                                               **kwargs):
+            if status_code != 200:
+                break
+            pages += 1
+            events += len(chunk)
+        self._log_request(username, room_id, status_code, events, start_time, whatsuapp_room,
+                          "History")
+        return pages, events
+
+    async def read_history_gen(self, users, concurrency=config.CONCURRENCY, **kwargs):
+        """Scroll through the full history of every joined room of every user."""
+        start_time = time.time()
 
-        except Exception as e:
-            print(f"Error reading CSV: {e}")
+        async def _user_history(user):
+            session = self.user_session(user)
+            result = {"rooms": 0, "pages": 0, "events": 0}
+            for item in await session.get_my_rooms():
+                pages, events = await session.read_room_history(
+                    item["room_id"], session.username, item["whatsuapp_member"], **kwargs)
+                result["rooms"] += 1
+                result["pages"] += pages
+                result["events"] += events
+            return result
+
+        summary = {"users": 0, "failed_users": 0, "rooms": 0, "pages": 0, "events": 0}
+        for result in await helper.run_concurrently(users, _user_history, concurrency,
+                                                    desc="history readers"):
+            if isinstance(result, Exception):
+                summary["failed_users"] += 1
+                continue
+            summary["users"] += 1
+            for key, value in result.items():
+                summary[key] += value
+        elapsed = time.time() - start_time
+        print(f"Read history of {summary['rooms']} rooms in {elapsed:0.1f}s "
+              f"({summary['pages'] / elapsed if elapsed else 0:0.1f} pages/s): {summary}")
+        return summary
+
+    def _log_delivery(self, room_id, event, send_time, received):
+        """Record the time from a message being sent to this listener receiving it."""
+        latency = received - send_time
+        if self.recorder is not None:
+            members = self.room_index.member_count(room_id)
+            self.recorder.record("Delivery", 200, room_size_bucket(members), latency)
+        if self.results is not None:
+            msg_size = len(event.get("content", {}).get("body", ""))
+            self.results.write(round(send_time, 6), self.agent, self.username, room_id, 200,
+                               msg_size, round(latency, 6),
+                               self.room_index.whatsuapp_member(room_id), "Delivery", 0.0)
+
+    async def start_delivery_listeners(self, users, concurrency=config.CONCURRENCY):
+        """Start a long-poll /sync listener for each user and return the listener tasks.
+
+        Returns once every listener has made its initial sync, so messages
+        sent from then on arrive in their incremental syncs. Each listener
+        has its own since-token, so it never takes events away from a virtual
+        user of the same account.
+        """
+        async def _start(user):
+            session = self.user_session(user)
+            session.sync_store = SyncTokenStore()
+            sync_state = await session.get_sync_state(filter=ROOM_LIST_FILTER)
+            if sync_state.next_batch is None:
+                raise RuntimeError(f"initial sync of listener {user.username} failed")
+            self.delivery.listen(session.username, sync_state.rooms)
+            return asyncio.create_task(session.listen_for_deliveries(sync_state))
+
+        results = await helper.run_concurrently(users, _start, concurrency,
+                                                desc="starting listeners")
+        return [task for task in results if not isinstance(task, Exception)]
+
+    async def listen_for_deliveries(self, sync_state):
+        """Long-poll /sync until cancelled, recording the delivery of tracked messages."""
+        own_id = (self.user_id or "").lstrip("@")
+        while True:
+            parser = SyncParser()
+            response = await self.sync(since=sync_state.next_batch,
+                                       timeout=config.DELIVERY_SYNC_TIMEOUT,
+                                       filter=self.delivery_filter, parser=parser)
+            received = time.time()
+            if response.status_code != 200:
+                print("❌ Error in listener sync:", response.status_code)
+                await asyncio.sleep(1)
+                continue
+            sync_state.update(parser.result(), self.room_index)
+            self.delivery.listen(self.username, sync_state.rooms)
+            for room_id in sync_state.limited:
+                self.delivery.gap(room_id, received)
+            for room_id, events in sync_state.timelines.items():
+                for event in events:
+                    if event.get("sender", "").lstrip("@") == own_id:
+                        continue
+                    send_time = self.delivery.match(event, self.username)
+                    if send_time is not None:
+                        self._log_delivery(room_id, event, send_time, received)
+            self.delivery.expire(received)
+
+    async def stop_delivery_listeners(self, listeners):
+        """Give outstanding messages time to arrive, stop the listeners and return counts."""
+        await self.delivery.wait(config.DELIVERY_GRACE)
+        for task in listeners:
+            task.cancel()
+        await asyncio.gather(*listeners, return_exceptions=True)
+        summary = self.delivery.summary()
+        print(f"Delivery: {summary}")
+        return summary
+
+    async def send_message_gen(self, users, message_set, concurrency=config.CONCURRENCY):
+        """Run every user as its own virtual user task, at most `concurrency` at a time."""
+        start_time = time.time()
+        results = await helper.run_concurrently(
+            users, functools.partial(self.user_message_gen, message_set=message_set),
+            concurrency, desc="virtual users")
+
+        summary = {"users": 0, "failed_users": 0, "rooms": 0,
+                   "reads": 0, "writes": 0, "write_errors": 0}
+        for result in results:
+            if isinstance(result, Exception):
+                summary["failed_users"] += 1
+                continue
+            summary["users"] += 1
+            for key, value in result.items():
+                summary[key] += value
+        elapsed = time.time() - start_time
+        print(f"Finished {summary['users']} users in {elapsed:0.1f}s "
+              f"({summary['writes'] / elapsed if elapsed else 0:0.1f} msg/s): {summary}")
+        return summary
+
+    async def user_message_gen(self, user, message_set):
+        """Read every joined room of one user, then send 1-9 messages to each of them."""
+        username = user.username
+        client = self.user_session(user)
+        result = {"rooms": 0, "reads": 0, "writes": 0, "write_errors": 0}
+
+        # One /sync per user per iteration, shared by all of the user's rooms
+        sync_state = await client.get_sync_state()
+        list_my_room_id = sync_state.room_list(client.room_index)
+        result["rooms"] = len(list_my_room_id)
+        # read all messages from user's room_id
+        for item in (list_my_room_id):
+            room_id = item['room_id']
+            whatsuapp_room = item['whatsuapp_member']
+            await client.get_room_all_messages(room_id, username, whatsuapp_room,
+                                               sync_state=sync_state)
+            result["reads"] += 1
+
+        for item in (list_my_room_id):
+            room_id = item['room_id']
+            whatsuapp_room = item['whatsuapp_member']
+            for i in range(1, random.randint(2, 10)):
+                random_message = str(i)+' - '+ random.choice(message_set)
+                ret = await client.send_message(room_id, random_message, username, whatsuapp_room)
+                result["writes"] += 1
+                if ret != 200:
+                    result["write_errors"] += 1
+        return result
+
+    async def send_message_open_loop(self, users, message_set, rate, duration,
+                                     arrival="constant", concurrency=config.CONCURRENCY,
+                                     ready=None):
+        """Send messages at a fixed offered load, independent of response times.
+
+        Sends are scheduled `rate` per second for `duration` seconds, either
+        evenly spaced ("constant") or as a Poisson process ("poisson"), each
+        to a random joined room of a random user. A send never waits for an
+        earlier one to finish, so server queueing shows up in the measured
+        latency instead of silently lowering the request rate. `ready` is
+        awaited after room discovery, right before the first send.
+        """
+        if rate <= 0 or duration <= 0:
+            raise ValueError(f"rate and duration must be greater than 0, got {rate} and {duration}")
+
+        async def _user_rooms(user):
+            session = self.user_session(user)
+            return [(session, item["room_id"], item["whatsuapp_member"])
+                    for item in await session.get_my_rooms()]
+
+        targets = []
+        for result in await helper.run_concurrently(users, _user_rooms, concurrency,
+                                                    desc="discovering rooms"):
+            if not isinstance(result, Exception):
+                targets.extend(result)
+        if ready:
+            await ready()
+        if not targets:
+            print("No rooms to send messages to")
+            return {}
+
+        async def _send(target, message, intended_start):
+            session, room_id, whatsuapp_room = target
+            return await session.send_message(room_id, message, session.username,
+                                              whatsuapp_room, intended_start=intended_start)
+
+        loop = asyncio.get_running_loop()
+        start_loop_time = loop.time()
+        start_time = time.time()
+        pending = set()
+        summary = {"scheduled": 0, "sent": 0, "errors": 0, "max_start_lag": 0.0,
+                   "max_in_flight": 0}
+
+        def _done(task):
+            pending.discard(task)
+            if task.cancelled() or task.exception() is not None or task.result() != 200:
+                summary["errors"] += 1
+        offset = 0.0
+        while True:
+            offset += random.expovariate(rate) if arrival == "poisson" else 1.0 / rate
+            if offset > duration:
+                break
+            delay = start_loop_time + offset - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            summary["max_start_lag"] = max(summary["max_start_lag"], -delay)
+            message = str(summary["scheduled"]) + ' - ' + random.choice(message_set)
+            task = asyncio.create_task(_send(random.choice(targets), message, start_time + offset))
+            pending.add(task)
+            task.add_done_callback(_done)
+            summary["scheduled"] += 1
+            summary["max_in_flight"] = max(summary["max_in_flight"], len(pending))
+
+        if pending:
+            await asyncio.wait(pending)
+        summary["sent"] = summary["scheduled"] - summary["errors"]
+        elapsed = time.time() - start_time
+        print(f"Offered {summary['scheduled'] / duration:0.1f} msg/s for {duration}s "
+              f"({arrival}), finished in {elapsed:0.1f}s: {summary}")
+        return summary
+
+    async def register_and_login(self, username, password, backend="client"):
+        """Register one user (logging in if it already exists); returns [username, user_id, access_token]."""
+        if backend == "admin":
+            response = await self.admin_register_user(username, password)
+        else:
+            response = await self.register_user(username, password)
+        if response.status_code == 200:
+            response = response.json()
+            if response.get("access_token"):
+                return [username, response["user_id"], response["access_token"]]
+        elif response.status_code != 400:
+            raise RuntimeError(f"Failed to register {username}. Response: {response.status_code}")
+        # Already registered (or registered without a token), log in to get one
+        login_response = await self.login(username, password)
+        if login_response.status_code != 200:
+            raise RuntimeError(f"Failed to login {username}. Response: {login_response.status_code}")
+        login_response = login_response.json()
+        return [username, login_response["user_id"], login_response["access_token"]]
+
+    async def register_users_from_csv(self, input_csv, output_csv, concurrency=config.CONCURRENCY,
+                                      backend="client"):
+        """Read users from CSV, register them concurrently, and save their credentials.
+
+        backend "client" uses the client registration API (m.login.dummy),
+        "admin" the shared-secret admin registration (see admin_register_user).
+
+        Every user is appended to `output_csv` as soon as it is done, so the
+        file doubles as a checkpoint: users already in it are skipped when the
+        run is repeated. A failing user is reported and does not stop the run.
+        """
+        done = set()  # usernames only; the one per-user structure kept in memory
+        if os.path.exists(output_csv):
+            done = {user.username for user in iter_users(output_csv) if user.access_token}
+        users = (user for user in iter_users(input_csv) if user.username not in done)
+        print(f"{len(done)} users already registered")
 
-    def get_user(self, user_list, user_id):
-        try:
-            filtered_users = list(
-                filter(lambda x: x["user_id"] == user_id, user_list))
-            # Equivalent to checking len(filtered_users) == 0
-            if not filtered_users:
-                return None
-            return filtered_users[0]['access_token']
-        except Exception as e:
-            print(f"Error filtering users: {e}")
-            return None
+        start_time = time.time()
+        with open(output_csv, mode="a", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            if file.tell() == 0:
+                writer.writerow(["username", "user_id", "access_token"])  # Headers
+
+            async def _register(user):
+                row = await self.register_and_login(user.username, user.password, backend)
+                writer.writerow(row)
+                file.flush()
+
+            total, failed = await helper.run_concurrently(users, _register, concurrency,
+                                                          desc="registering users", collect=False)
+        elapsed = time.time() - start_time
+        print(f"Registered {total - failed} users ({failed} failed) in {elapsed:0.1f}s "
+              f"({(total - failed) / elapsed if elapsed else 0:0.1f} users/s)")
+        return failed
 
     async def get_my_rooms(self):
-        endpoint = "/_matrix/client/v3/sync"
-        delay = 1
-        retries = 5
-        for i in range(retries):
-            response = await self._request("GET", endpoint)
-            if response.status_code == 200:
-                data = response.json()
-                invited_rooms = data.get("rooms", {}).get("join", {})
-                room_list = []
-                for i in invited_rooms:
-                    # print("")
-                    # print("====================================")
-                    # print('checking rooms:', i)
-                
-                    whatsapp_member = False
-                    whatsapp_bot = False
-                    isBridge = False
-                    for ii in invited_rooms[i]["state"]["events"]:
-                        # print(ii["type"])
-                        # print(ii["sender"])
-
-                        # if ii["type"] == "m.room.member":
-                        #     print(ii["sender"])
-                        if (ii["type"] == "m.bridge"):
-                            isBridge = True
-                        if (ii["type"] == "m.room.member") & (ii['sender'].startswith('@whatsapp_')):
-                            whatsapp_member = True
-                        if (ii["type"] == "m.room.member") & (ii['sender'].startswith('@whatsapp-mudita')):
-                            whatsapp_bot = True
-                        
-                    # print('whatsuapp_member:', whatsapp_member)
-                    # print('whatsuapp_bot:', whatsapp_bot)
-                    # print('isBridge:', isBridge)
-                    
-                    
-                
-                    # Smiec
-                    # whatsuapp_member: True
-                    # whatsuapp_bot: True
-                    # isBridge: False
-
-                    if (whatsapp_member == True) & (whatsapp_bot == True) & (isBridge == False):
-                        s=True
-
-                    # bot
-                    # whatsuapp_member: False
-                    # whatsuapp_bot: True
-                    # isBridge: False
-                    if (whatsapp_member == False) & (whatsapp_bot == True) & (isBridge == False):
-                        b=True
-                    
-                    if (whatsapp_member == True) & (whatsapp_bot == True) & (isBridge == True):
-                        room_list.append(
-                            {"room_id": i, "whatsuapp_member": whatsapp_member})
-                    
-                    if (whatsapp_member == False) & (whatsapp_bot == False) & (isBridge == False):
-                        room_list.append(
-                            {"room_id": i, "whatsuapp_member": whatsapp_member})
-
-
-
-
-            return room_list  # Return list of room IDs
-
-            if response.status_code == 429:
-                print(f"Rate limited, retrying in {delay} seconds...")
-                await asyncio.sleep(delay)
-                delay *= 2
-            else:
-                print("❌ Error fetching invites:", response.status_code)
-                return []
-        return []
+        """Return the user's bridged and native rooms as [{"room_id", "whatsuapp_member"}]."""
+        sync_state = await self.get_sync_state(filter=ROOM_LIST_FILTER)
+        return sync_state.room_list(self.room_index)  # Return list of room IDs
 
     async def get_invited_rooms(self):
-        endpoint = "/_matrix/client/v3/sync"
-        delay = 1
-        retries = 5
-        for i in range(retries):
-            response = await self._request("GET", endpoint)
-            if response.status_code == 200:
-                data = response.json()
-                invited_rooms = data.get("rooms", {}).get("invite", {})
-                return list(invited_rooms.keys())  # Return list of room IDs
-
-            if response.status_code == 429:
-                print(f"Rate limited, retrying in {delay} seconds...")
-                await asyncio.sleep(delay)
-                delay *= 2
-            else:
-                print("❌ Error fetching invites:", response.status_code)
-                return []
-        return []
+        sync_state = await self.get_sync_state(filter=ROOM_LIST_FILTER)
+        return sorted(sync_state.invites)  # Return list of room IDs
 
     async def accept_invitation(self, room_id):
         endpoint = f"/_matrix/client/v3/rooms/{room_id}/join"
-        delay = 1
-        retries = 5
-        for i in range(retries):
-            response = await self._request("POST", endpoint)
-            if response.status_code == 200:
-                return response
-            if response.status_code == 429:
-                print(f"Rate limited, retrying in {delay} seconds...")
-                await asyncio.sleep(delay)
-                delay *= 2
-            else:
-                return response
-        return None
+        return await self._request("POST", endpoint)
 
-    async def accept_all_invitation(self, user_csv, rooms_json):
+    async def accept_all_invitation(self, users, rooms_json):
+        """Join every pending invite of every user of an iterable of UserRecords."""
         try:
-            with open(user_csv, mode="r", encoding="utf-8") as file:
-                reader = csv.DictReader(file)
-                users = list(reader)
-
             for user in tqdm(users):
-                access_token = user["access_token"]
-                username = user["username"]
-                self.set_access_token(access_token)
+                username = user.username
+                session = self.user_session(user)
                 # print("check invitation for user: ", username)
-                invited_rooms = await self.get_invited_rooms()
+                invited_rooms = await session.get_invited_rooms()
                 if len(invited_rooms) > 0:
                     for room_id in invited_rooms:
-                        response = await self.accept_invitation(room_id)
-                        if response.status_code != 200:
+                        response = await session.accept_invitation(room_id)
+                        if response is None or response.status_code != 200:
                             print(
                                 f"Failed to accept invitation for user: {username} from room {room_id}")
                 # joined_rooms = await self.get_my_rooms()
@@ -408,25 +698,23 @@ class SynapseClient(MatrixAPI):
         except Exception as e:
             print(f"Error reading Files: {e}")
 
-    async def create_dm_rooms(self, user_csv):
+    async def create_dm_rooms(self, users):
+        """Create DM rooms between random pairs of users of a UserRegistry."""
         try:
-            with open(user_csv, mode="r", encoding="utf-8") as file:
-                reader = csv.DictReader(file)
-                users = list(reader)
-
-            for idx, user in tqdm(enumerate(users)):
+            records = users.records
+            for idx, user in tqdm(enumerate(records)):
                 n = random.uniform(0.005, 0.05)
-                dm_room_peers = [item["user_id"]
-                                 for item in helper.select_random_n_percent(users[idx:], n)]
+                dm_room_peers = [item.user_id
+                                 for item in helper.select_random_n_percent(records[idx:], n)]
 
                 if (len(dm_room_peers) > 0):
-                    user_id = user["user_id"]
-                    user_access_token = self.get_user(users, user_id)
+                    user_id = user.user_id
+                    user_access_token = user.access_token
                     if user_access_token:
+                        session = self.user_session(user)
                         for peer in dm_room_peers:
 
-                            self.set_access_token(user_access_token)
-                            ret = await self.create_dm_room(peer)
+                            ret = await session.create_dm_room(peer)
                             if ret.status_code != 200:
                                 print(
                                     f"Failed to create DM room between {user_id} and {peer}. Response: {ret.status_code}")
@@ -437,73 +725,114 @@ class SynapseClient(MatrixAPI):
         except Exception as e:
             print(f"Error reading Files or other Exception: {e}")
 
-    async def create_rooms_from_csv(self, user_csv, rooms_json,):
-        try:
-            rooms = {}
-            with open(rooms_json, "r", encoding="utf-8") as rooms_jsonfile:
-                rooms = json.load(rooms_jsonfile)
-            print("Success loading rooms list")
-
-            with open(user_csv, mode="r", encoding="utf-8") as file:
-                reader = csv.DictReader(file)
-                users = list(reader)
-
-            for room_name, room_users in tqdm(rooms.items()):
-
-                # print(room_name, room_users)
-                owner = room_users[0]
-                user_rooms = room_users[1:]
-
-                owner_access_token = self.get_user(users, owner)
-                if owner_access_token:
-                    self.set_access_token(owner_access_token)
-                    ret = await self.create_room(room_name)
-                    if ret.status_code == 200:
-                        create_root_ret = ret.json()
-                        room_id = create_root_ret['room_id']
-
-                        for user in tqdm(user_rooms):
-                            response = await self.invite_users(room_id, user)
-                    else:
-                        print(
-                            f"Failed to create room {room_name}. Response: {ret.status_code}")
-                else:
-                    print(f"Owner {owner} not found in users list")
+    async def create_rooms_from_csv(self, users, rooms_json, concurrency=config.CONCURRENCY):
+        """Create the rooms of rooms_json, owned by users of a UserRegistry, concurrently.
+
+        Members are invited as part of createRoom (see create_room_with_members).
+        Each owner's requests still go through its own per-user rate limits.
+        """
+        with open(rooms_json, "r", encoding="utf-8") as rooms_jsonfile:
+            rooms = json.load(rooms_jsonfile)
+        print("Success loading rooms list")
+        counts = {"rooms": 0, "failed_rooms": 0, "invites": 0, "failed_invites": 0}
+
+        async def _create(item):
+            room_name, room_users = item
+            owner = users.get(room_users[0])
+            if owner is None or not owner.access_token:
+                print(f"Owner {room_users[0]} not found in users list")
+                counts["failed_rooms"] += 1
+                return
+            members = [normalize_user_id(user_id) for user_id in room_users[1:]]
+            response, invited, failed = await self.user_session(owner).create_room_with_members(
+                room_name, [user_id for user_id in members if user_id != owner.user_id])
+            if response.status_code != 200:
+                print(f"Failed to create room {room_name}. Response: {response.status_code}")
+                counts["failed_rooms"] += 1
+                return
+            counts["rooms"] += 1
+            counts["invites"] += len(invited)
+            counts["failed_invites"] += failed
 
-        except Exception as e:
-            print(f"Error reading Files: {e}")
-
-    async def login_users_from_csv(self, input_csv, output_csv):
-        """Read users from CSV, login them, and save their credentials."""
-        try:
-            with open(input_csv, mode="r", encoding="utf-8") as file:
-                reader = csv.DictReader(file)
-                users = list(reader)
-
-            with open(output_csv, mode="w", encoding="utf-8", newline="") as file:
-                writer = csv.writer(file)
-                writer.writerow(
-                    ["username", "user_id", "access_token"])  # Headers
-
-                for user in users:
-                    username = user["username"]
-                    password = user["password"]
-                    # print(
-                    #     f"Login user: {username} and password: {password}")
-
-                    login_response = await self.login(username, password)
-                    # print(f"Login response: {login_response}")
-                    if login_response:
-
-                        access_token = login_response.get(
-                            "access_token", "N/A") if login_response else "N/A"
-                        user_id = login_response.get(
-                            "user_id", "N/A") if login_response else "N/A"
-                        # Save user_id and access_token
-                        writer.writerow([username, user_id, access_token])
-                    else:
-                        print(
-                            f"Failed to login {username}. Response: {login_response}")
+        start_time = time.time()
+        await helper.run_concurrently(rooms.items(), _create, concurrency, desc="creating rooms",
+                                      collect=False)
+        elapsed = time.time() - start_time
+        print(f"Created {counts['rooms']} rooms in {elapsed:0.1f}s "
+              f"({counts['rooms'] / elapsed if elapsed else 0:0.1f} rooms/s, "
+              f"{counts['invites'] / elapsed if elapsed else 0:0.1f} invites/s): {counts}")
+        return counts
+
+    async def login_users_from_csv(self, input_csv, output_csv, concurrency=config.CONCURRENCY,
+                                   mode="password", reuse=True):
+        """Read users from CSV, get an access token for each of them concurrently, and save
+        their credentials.
+
+        With `reuse`, tokens already in `output_csv` are checked with
+        /account/whoami and kept if still valid; only the other users get a
+        new token. mode "password" logs users in; "admin" has the admin
+        "login as user" API mint the tokens (see admin_login_as), which
+        avoids a password check and is not rate limited.
+        """
+        users = iter_users(input_csv)
+        # Indexed by username; the input roster itself is only streamed
+        known_users = UserRegistry(output_csv if reuse else None)
+        counts = {"reused": 0, "new": 0}
+
+        if mode == "admin":
+            admin = await self.admin_session()
+
+            async def _token(user):
+                user_id = f"@{user.username}:{config.DOMAIN}"
+                return [user.username, user_id, await admin.admin_login_as(user_id)]
+        else:
+            async def _token(user):
+                login_response = await self.login(user.username, user.password)
+                if login_response.status_code != 200:
+                    raise RuntimeError(f"Failed to login {user.username}. "
+                                       f"Response: {login_response.status_code}")
+                login_response = login_response.json()
+                return [user.username, login_response["user_id"], login_response["access_token"]]
+
+        async def _valid_token(user):
+            known = known_users.get_by_username(user.username)
+            if known is None or not known.access_token:
+                return None
+            user_id = await self.user_session(known).whoami()
+            # A token of another user is as useless as an expired one
+            if user_id is None or user_id != normalize_user_id(known.user_id):
+                return None
+            return [user.username, user_id, known.access_token]
 
-        except Exception as e:
-            print(f"Error reading CSV: {e}")
+        start_time = time.time()
+        # Written next to the old file and swapped in at the end, so an
+        # interrupted run does not lose the tokens it has not checked yet
+        tmp_filename = output_csv + ".tmp"
+        with open(tmp_filename, mode="w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["username", "user_id", "access_token"])  # Headers
+
+            async def _login(user):
+                row = await _valid_token(user)
+                if row is None:
+                    try:
+                        row = await _token(user)
+                    except Exception:
+                        # Keep the user's old row rather than drop them from the roster
+                        known = known_users.get_by_username(user.username)
+                        if known is not None:
+                            writer.writerow([known.username, known.user_id, known.access_token])
+                        raise
+                    counts["new"] += 1
+                else:
+                    counts["reused"] += 1
+                writer.writerow(row)
+
+            total, failed = await helper.run_concurrently(users, _login, concurrency,
+                                                          desc="getting tokens", collect=False)
+        os.replace(tmp_filename, output_csv)
+        elapsed = time.time() - start_time
+        print(f"Got tokens for {total - failed} users ({counts['reused']} still valid, "
+              f"{counts['new']} new, {failed} failed) in {elapsed:0.1f}s "
+              f"({(total - failed) / elapsed if elapsed else 0:0.1f} users/s)")
+        return failed
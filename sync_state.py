@@ -0,0 +1,237 @@
+import json
+import os
+from room_index import BRIDGED, NATIVE
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:  # Fall back to parsing the whole response at once
+    ijson = None
+
+
+# State event types the room index needs to classify rooms
+CLASSIFICATION_STATE_TYPES = ("m.bridge", "m.room.member")
+
+
+def sync_filter(state_types=CLASSIFICATION_STATE_TYPES, timeline_limit=10,
+                lazy_load_members=False, timeline_types=("m.room.message",)):
+    """Build a /sync filter definition that only returns what the load needs.
+
+    Account data, presence, receipts and typing are always dropped; room
+    state is limited to `state_types`, timelines to `timeline_limit` events
+    of `timeline_types`. Lazy-loading members shrinks state further but then
+    the room index only sees the members that sent timeline events.
+    """
+    none = {"not_types": ["*"]}
+    state = {"types": list(state_types)} if state_types else dict(none)
+    state["lazy_load_members"] = lazy_load_members
+    timeline = {"limit": timeline_limit}
+    if timeline_types:
+        timeline["types"] = list(timeline_types)
+    return {
+        "account_data": none,
+        "presence": none,
+        "room": {
+            "account_data": none,
+            "ephemeral": none,
+            "state": state,
+            "timeline": timeline,
+        },
+    }
+
+
+# Just the room list (and invites): classification state, no timelines
+ROOM_LIST_FILTER = sync_filter(timeline_limit=0)
+
+
+class SyncState:
+    """One user's view of the server, built from an initial /sync and its increments.
+
+    Fetched once per user per iteration and shared by every room of that
+    user, instead of issuing another full /sync for each room. `next_batch`
+    is used as `since` for the next /sync, so after the first (initial) sync
+    only changes are transferred. Room classification lives in the shared
+    room_index.RoomIndex.
+    """
+
+    def __init__(self, next_batch=None, rooms=None, invites=None):
+        self.next_batch = next_batch
+        self.rooms = set(rooms or ())  # Joined room ids
+        self.invites = set(invites or ())
+        self.timelines = {}  # room_id -> timeline events from the last sync
+        self.limited = set()  # Rooms whose timeline in the last sync left events out
+
+    def update(self, data, room_index):
+        """Apply a /sync response body (initial or incremental).
+
+        State is only scanned for rooms the index does not know yet, or when
+        the body is an incremental delta.
+        """
+        incremental = self.next_batch is not None
+        self.next_batch = data.get("next_batch", self.next_batch)
+        rooms = data.get("rooms", {})
+        self.timelines = {}
+        self.limited = set()
+        for room_id, room in rooms.get("join", {}).items():
+            state_events = room.get("state", {}).get("events", [])
+            if room_id not in room_index or (incremental and state_events):
+                room_index.update(room_id, state_events)
+            self.rooms.add(room_id)
+            timeline = room.get("timeline", {})
+            self.timelines[room_id] = timeline.get("events", [])
+            if timeline.get("limited"):
+                self.limited.add(room_id)
+            self.invites.discard(room_id)
+        for room_id in rooms.get("leave", {}):
+            self.rooms.discard(room_id)
+            self.invites.discard(room_id)
+        self.invites.update(rooms.get("invite", {}).keys())
+
+    def to_json(self):
+        return {"next_batch": self.next_batch, "rooms": sorted(self.rooms),
+                "invites": sorted(self.invites)}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data.get("next_batch"), data.get("rooms"), data.get("invites"))
+
+    def room_list(self, room_index):
+        """Bridged and native rooms in the format returned by SynapseClient.get_my_rooms."""
+        return [{"room_id": room_id, "whatsuapp_member": room_index.whatsuapp_member(room_id)}
+                for room_id in self.rooms
+                if room_index.room_type(room_id) in (BRIDGED, NATIVE)]
+
+
+class SyncTokenStore:
+    """Per-user SyncStates (since-tokens and room lists) persisted as JSON between runs.
+
+    A run started from a loaded store is "warm": every user continues with an
+    incremental /sync. A run with an empty store is "cold": every user starts
+    with an initial sync.
+    """
+
+    def __init__(self, filename=None):
+        self.states = {}
+        self.touched = set()  # Users whose state was used (and possibly advanced) in this run
+        if filename and os.path.exists(filename):
+            with open(filename, mode="r", encoding="utf-8") as file:
+                self.states = {user: SyncState.from_json(state)
+                               for user, state in json.load(file).items()}
+
+    def get(self, user):
+        """Return the user's SyncState, creating an empty (cold) one if needed."""
+        self.touched.add(user)
+        state = self.states.get(user)
+        if state is None:
+            state = self.states[user] = SyncState()
+        return state
+
+    def merge(self, other):
+        self.states.update(other.states)
+
+    def save(self, filename, touched_only=False):
+        """Write the store atomically; `touched_only` leaves out users not used in this run."""
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, mode="w", encoding="utf-8") as file:
+            json.dump({user: state.to_json() for user, state in self.states.items()
+                       if not touched_only or user in self.touched}, file)
+        os.replace(tmp_filename, filename)
+
+
+class SyncParser:
+    """Incremental /sync response parser.
+
+    Fed with body chunks while they arrive, it keeps only what SyncState
+    needs: next_batch, the joined/invited/left room ids, the type, sender
+    and state_key (plus membership) of state events, the timeline events and
+    whether a timeline was `limited` (events were left out). The full
+    document tree is never built, so memory does not grow with the size of
+    the initial sync. Without ijson installed the body is buffered and
+    parsed at the end instead.
+    """
+
+    # Kept fields of state events; the room index only needs these
+    STATE_FIELDS = ("type", "sender", "state_key")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.size = 0
+        self.body = {"rooms": {"join": {}, "invite": {}, "leave": {}}}
+        self.path = []
+        self.builder = None
+        self.builder_depth = 0
+        self.chunks = []
+        if ijson is not None:
+            self.events = ijson.sendable_list()
+            self.coro = ijson.basic_parse_coro(self.events)
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if ijson is None:
+            self.chunks.append(chunk)
+            return
+        self.coro.send(chunk)
+        self._process()
+
+    def close(self):
+        if ijson is None:
+            self.body = json.loads(b"".join(self.chunks))
+            self.chunks = []
+            return
+        self.coro.close()
+        self._process()
+
+    def result(self):
+        """The parsed body, in the same shape as the /sync JSON, for SyncState.update."""
+        return self.body
+
+    def _process(self):
+        for event, value in self.events:
+            if self.builder is not None:
+                self._build(event, value)
+                continue
+            path = self.path
+            if event == "map_key":
+                path[-1] = value
+                if len(path) == 3 and path[0] == "rooms" and path[1] in self.body["rooms"]:
+                    self.body["rooms"][path[1]][value] = {} if path[1] != "join" else {
+                        "state": {"events": []}, "timeline": {"events": []}}
+            elif event == "start_map":
+                if (len(path) == 6 and path[0] == "rooms" and path[1] == "join"
+                        and path[3] in ("state", "timeline") and path[4] == "events"):
+                    self.builder = ObjectBuilder()
+                    self.builder_depth = 0
+                    self._build(event, value)
+                else:
+                    path.append(None)
+            elif event == "start_array":
+                path.append("item")
+            elif event in ("end_map", "end_array"):
+                path.pop()
+            elif path == ["next_batch"]:
+                self.body["next_batch"] = value
+            elif (event == "boolean" and value and len(path) == 5 and path[:2] == ["rooms", "join"]
+                    and path[3:] == ["timeline", "limited"]):
+                self.body["rooms"]["join"][path[2]]["timeline"]["limited"] = True
+        del self.events[:]
+
+    def _build(self, event, value):
+        """Feed one parser event into the event object being built."""
+        self.builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            self.builder_depth += 1
+        elif event in ("end_map", "end_array"):
+            self.builder_depth -= 1
+        if self.builder_depth:
+            return
+        room_id, section = self.path[2], self.path[3]
+        item = self.builder.value
+        if section == "state":
+            membership = item.get("content", {}).get("membership")
+            item = {field: item[field] for field in self.STATE_FIELDS if field in item}
+            if membership is not None:
+                item["content"] = {"membership": membership}
+        self.body["rooms"]["join"][room_id][section]["events"].append(item)
+        self.builder = None
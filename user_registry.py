@@ -0,0 +1,86 @@
+import csv
+import itertools
+import os
+
+
+def normalize_user_id(user_id):
+    """Matrix user id with its leading '@' (some registered_users.csv rows lack it)."""
+    if user_id and not user_id.startswith("@"):
+        return "@" + user_id
+    return user_id
+
+
+class UserRecord:
+    """One test user; __slots__ keep a record small for large rosters."""
+
+    __slots__ = ("username", "user_id", "access_token", "password")
+
+    def __init__(self, username, user_id=None, access_token=None, password=None):
+        self.username = username
+        self.user_id = normalize_user_id(user_id)
+        self.access_token = access_token
+        self.password = password
+
+    def __repr__(self):
+        return f"UserRecord({self.username!r}, {self.user_id!r})"
+
+
+def iter_users(filename):
+    """Yield the users of a roster CSV one UserRecord at a time.
+
+    Nothing but the current row is kept in memory, so provisioning and load
+    runs can start on rosters of any size right away.
+    """
+    with open(filename, mode="r", encoding="utf-8") as file:
+        for row in csv.DictReader(file):
+            yield UserRecord(row["username"], row.get("user_id"),
+                             row.get("access_token"), row.get("password"))
+
+
+def iter_shard(users, index, count):
+    """Every `count`-th user of an iterable starting at `index`; shards are disjoint."""
+    return itertools.islice(users, index, None, count)
+
+
+class UserRegistry:
+    """Test users loaded once from registered_users.csv, indexed by user_id and username.
+
+    Shared by provisioning code that looks users up instead of scanning
+    user lists. Code that only walks the roster once should use
+    `iter_users` (and `iter_shard`) instead.
+    """
+
+    def __init__(self, filename=None):
+        self.records = []
+        self.by_user_id = {}
+        self.by_username = {}
+        self.positions = {}  # username -> position in records
+        if filename and os.path.exists(filename):
+            for record in iter_users(filename):
+                self.add(record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def add(self, record):
+        """Add a user, replacing an earlier record with the same username."""
+        old = self.by_username.get(record.username)
+        if old is not None:
+            self.records[self.positions[record.username]] = record
+            self.by_user_id.pop(old.user_id, None)
+        else:
+            self.positions[record.username] = len(self.records)
+            self.records.append(record)
+        self.by_username[record.username] = record
+        if record.user_id:
+            self.by_user_id[record.user_id] = record
+
+    def get(self, user_id):
+        """Record of a user id (with or without '@'), or None."""
+        return self.by_user_id.get(normalize_user_id(user_id))
+
+    def get_by_username(self, username):
+        return self.by_username.get(username)